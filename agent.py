@@ -0,0 +1,144 @@
+import atexit
+import inspect
+import json
+import os
+import shlex
+import subprocess
+import sys
+
+# Answer JSON-lines requests ({"id", "op", "args"}) from stdin, in order, until stdin closes
+# - Responses are {"id", "result"} or {"id", "error"}, preceded by any {"id", "line"} messages of a streamed result
+# - Imports are local so that the source of this function can be run within a host container
+def serve():
+    import json
+    import os
+    import subprocess
+    import sys
+    import threading
+
+    def respond(message):
+        sys.stdout.write(json.dumps(message) + '\n')
+        sys.stdout.flush()
+
+    def trace(request_id, command, script):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        def write_script():
+            process.stdin.write(script.encode('utf-8', 'surrogateescape'))
+            process.stdin.close()
+        writer = threading.Thread(target=write_script)
+        writer.start()
+        for line in process.stdout:
+            respond({'id': request_id, 'line': line.decode('utf-8', 'surrogateescape')})
+        writer.join()
+        return process.wait()
+
+    def read_file(path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', errors='surrogateescape') as file:
+            return file.read()
+
+    def pip_freeze():
+        return subprocess.run('pip freeze', shell=True, capture_output=True, text=True).stdout
+
+    def python_packages():
+        module_paths = read_module_paths()
+        return {'module_paths': module_paths, 'distributions': read_distribution_records(module_paths)}
+
+    operations = {'python_packages': lambda request_id: python_packages(),
+                  'module_path_mtimes': lambda request_id: read_module_path_mtimes(),
+                  'pip_freeze': lambda request_id: pip_freeze(),
+                  'existing_paths': lambda request_id, paths: filter_existing_paths(paths),
+                  'read_file': lambda request_id, path: read_file(path),
+                  'trace': trace}
+    for request in sys.stdin:
+        request = json.loads(request)
+        try:
+            respond({'id': request['id'], 'result': operations[request['op']](request['id'], **request['args'])})
+        except Exception as error:
+            respond({'id': request['id'], 'error': f'{type(error).__name__}: {error}'})
+
+# Retrieve the source of the helper agent (the functions it serves are shared with local runs)
+def get_agent_source():
+    from pathcheck import filter_existing_paths
+    from resolver import read_distribution_records, read_module_path_mtimes, read_module_paths
+    functions = [read_module_paths, read_module_path_mtimes, read_distribution_records, filter_existing_paths, serve]
+    return '\n'.join([inspect.getsource(function) for function in functions] + ['serve()'])
+
+# Class that sends requests to a long-lived helper agent over a single JSON-lines stream
+class HelperAgent:
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, errors='surrogateescape')
+        self.next_id = 0
+        self.messages = {} # Messages received for requests that have not been waited on yet
+
+    # Start a helper agent within a host container
+    @classmethod
+    def start(cls, host_container):
+        return cls(f'docker exec -i {host_container} python3 -u -c {shlex.quote(get_agent_source())}')
+
+    # Start a helper agent as a local subprocess (a stand-in for a host container that uses the same protocol)
+    @classmethod
+    def local(cls):
+        return cls(f'{shlex.quote(sys.executable)} -u -c {shlex.quote(get_agent_source())}')
+
+    # Send a request without waiting for its result (requests are answered in the order they are sent)
+    def submit(self, op, **args):
+        request_id = self.next_id
+        self.next_id += 1
+        self.process.stdin.write(json.dumps({'id': request_id, 'op': op, 'args': args}) + '\n')
+        self.process.stdin.flush()
+        return request_id
+
+    # Wait for the result of a request (lines of a streamed result are passed to on_line as they arrive)
+    def result(self, request_id, on_line=None):
+        messages = iter(self.messages.pop(request_id, []))
+        while True:
+            message = next(messages, None)
+            if message is None:
+                response = self.process.stdout.readline()
+                if response == '':
+                    raise RuntimeError('helper agent exited before responding')
+                message = json.loads(response)
+                if message['id'] != request_id:
+                    self.messages.setdefault(message['id'], []).append(message)
+                    continue
+            if 'line' not in message:
+                return self.unwrap(message)
+            if on_line is not None:
+                on_line(message['line'])
+
+    # Send a request and wait for its result
+    def request(self, op, on_line=None, **args):
+        return self.result(self.submit(op, **args), on_line)
+
+    # Retrieve the result of a response (or raise the error that the agent responded with)
+    def unwrap(self, message):
+        if 'error' in message:
+            raise RuntimeError(f'helper agent request failed: {message["error"]}')
+        return message['result']
+
+    # Stop the helper agent
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+# Helper agents, reused by every target that is traced in the same container
+# - Agents are keyed by process so that worker processes (e.g. forked by --jobs) start their own
+AGENTS = {}
+
+# Retrieve the helper agent of a host container (started on first use)
+def connect(host_container):
+    key = (os.getpid(), host_container)
+    if key not in AGENTS:
+        AGENTS[key] = HelperAgent.start(host_container)
+    return AGENTS[key]
+
+# Stop every helper agent of the current process
+@atexit.register
+def disconnect():
+    for (pid, host_container), helper in list(AGENTS.items()):
+        if pid == os.getpid():
+            helper.close()
+            del AGENTS[(pid, host_container)]
@@ -0,0 +1,194 @@
+import array
+import mmap
+import re
+import struct
+from tracing import ARCHIVE_MAGIC, DECODED_PATTERN, PORT_PATTERN, PROCESS_PATTERN, QUOTED_PATTERN, RESULT_PATTERN, TraceAnalysis
+
+# Layout of a trace archive (native byte order):
+# - Header: magic, version and the number of calls, extra references, paths and syscalls
+# - Time column (one 8-byte float per call): timestamp of timed traces (-1 if missing)
+# - Call columns (one 4-byte integer per call): pid, syscall, path, fd path, port and result of process calls (-1 if missing)
+# - Extra reference columns (for calls that reference more than one path or port): call, kind and value
+# - String tables (paths and syscalls): offsets of each string followed by the UTF-8 encoded strings
+# Version 1 archives have neither the time column nor the result column, so they cannot be used to time commands
+ARCHIVE_VERSION = 2
+HEADER = struct.Struct('=4sIIIII')
+CALL_COLUMNS = ['pid', 'syscall', 'path', 'fd', 'port', 'result']
+EXTRA_COLUMNS = ['call', 'kind', 'value']
+QUOTED, DECODED, PORT = 0, 1, 2
+
+# Pattern used to extract the pid (if traced with --follow-forks), the timestamp (if timed) and the syscall name of a system call
+CALL_PATTERN = re.compile('^\\s*(?:(\\d+)\\s+)?(?:(\\d[\\d:.]*)\\s+)?(?:<\\.\\.\\.\\s+)?([A-Za-z_]\\w*)')
+
+# System calls whose results (i.e. process ids) are used to time commands
+PROCESS_SYSCALLS = {'clone', 'clone3', 'fork', 'vfork', 'wait4'}
+
+# Class that builds a trace archive from the system calls of a trace log
+class TraceArchiveWriter:
+    def __init__(self):
+        self.times = array.array('d')
+        self.calls = {column: array.array('i') for column in CALL_COLUMNS}
+        self.extras = {column: array.array('i') for column in EXTRA_COLUMNS}
+        self.paths = {} # Interned path -> id
+        self.syscalls = {} # Interned syscall -> id
+
+    # Add a single system call to the archive
+    def add(self, call):
+        if call.strip() == '':
+            return
+        match = CALL_PATTERN.match(call)
+        pid = int(match.group(1)) if match is not None and match.group(1) is not None else 0
+        syscall = match.group(3) if match is not None else '?'
+        time = float(match.group(2)) if match is not None and match.group(2) is not None and match.group(2).count(':') == 0 else -1.0
+        result = RESULT_PATTERN.search(call) if syscall in PROCESS_SYSCALLS else None
+        references = [(QUOTED, self.paths.setdefault(path, len(self.paths))) for path in QUOTED_PATTERN.findall(call)]
+        references += [(DECODED, self.paths.setdefault(path, len(self.paths))) for path in DECODED_PATTERN.findall(call)]
+        if 'sin_port' in call:
+            references += [(PORT, int(port)) for port in PORT_PATTERN.findall(call) if port != '']
+
+        # The first reference of each kind is stored in the call's columns, and any others as extra references
+        index = len(self.calls['pid'])
+        columns = {'pid': pid, 'syscall': self.syscalls.setdefault(syscall, len(self.syscalls)), 'path': -1, 'fd': -1, 'port': -1,
+                   'result': int(result.group(1)) if result is not None else -1}
+        for kind, value in references:
+            column = CALL_COLUMNS[kind + 2]
+            if columns[column] == -1:
+                columns[column] = value
+                continue
+            self.extras['call'].append(index)
+            self.extras['kind'].append(kind)
+            self.extras['value'].append(value)
+        for column, value in columns.items():
+            self.calls[column].append(value)
+        self.times.append(time)
+
+    # Write the archive to a file
+    def write(self, path):
+        with open(path, 'wb') as file:
+            file.write(HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(self.calls['pid']), len(self.extras['call']), len(self.paths), len(self.syscalls)))
+            self.times.tofile(file) # Follows the header, which keeps it aligned
+            for column in CALL_COLUMNS:
+                self.calls[column].tofile(file)
+            for column in EXTRA_COLUMNS:
+                self.extras[column].tofile(file)
+            for table in [self.paths, self.syscalls]:
+                strings = [string.encode('utf-8', 'surrogateescape') for string in table]
+                offsets = array.array('I', [0])
+                for string in strings:
+                    offsets.append(offsets[-1] + len(string))
+                offsets.tofile(file)
+                file.write(b''.join(strings))
+
+# Class that reads a memory-mapped trace archive
+class TraceArchive:
+    def __init__(self, file):
+        self.file = file
+        self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        magic, version, calls, extras, paths, syscalls = HEADER.unpack_from(self.buffer)
+        if magic != ARCHIVE_MAGIC or version not in [1, ARCHIVE_VERSION]:
+            self.close()
+            raise ValueError(f'{file.name} is not a version 1 or {ARCHIVE_VERSION} trace archive')
+
+        # Map each column and string table onto the archive without copying it
+        offset = HEADER.size
+        self.times = None
+        if version >= 2:
+            self.times, offset = self.map_array('d', offset, calls)
+        self.calls = {}
+        for column in CALL_COLUMNS if version >= 2 else CALL_COLUMNS[:-1]:
+            self.calls[column], offset = self.map_array('i', offset, calls)
+        self.extras = {}
+        for column in EXTRA_COLUMNS:
+            self.extras[column], offset = self.map_array('i', offset, extras)
+        self.path_offsets, offset = self.map_array('I', offset, paths + 1)
+        self.path_strings, offset = self.map_bytes(offset, self.path_offsets[-1])
+        self.syscall_offsets, offset = self.map_array('I', offset, syscalls + 1)
+        self.syscall_strings, offset = self.map_bytes(offset, self.syscall_offsets[-1])
+
+    # Open a trace archive
+    @classmethod
+    def open(cls, path):
+        return cls(open(path, 'rb'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Release the archive's memory map
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.buffer.close()
+        self.file.close()
+
+    # Map a view of bytes from the archive
+    def map_bytes(self, offset, size):
+        view = memoryview(self.buffer)[offset:offset + size]
+        self.views.append(view)
+        return view, offset + size
+
+    # Map a view of integers from the archive
+    def map_array(self, typecode, offset, length):
+        view, end = self.map_bytes(offset, length * array.array(typecode).itemsize)
+        view = view.cast(typecode)
+        self.views.append(view)
+        return view, end
+
+    # Retrieve an interned path
+    def get_path(self, path_id):
+        return str(self.path_strings[self.path_offsets[path_id]:self.path_offsets[path_id + 1]], 'utf-8', 'surrogateescape')
+
+    # Retrieve an interned syscall
+    def get_syscall(self, syscall_id):
+        return str(self.syscall_strings[self.syscall_offsets[syscall_id]:self.syscall_offsets[syscall_id + 1]], 'utf-8', 'surrogateescape')
+
+    # Derive the trace analysis (paths, ports, versions and, for timed traces, commands) from the archive
+    def get_analysis(self):
+        analysis = TraceAnalysis()
+        for path_id in range(len(self.path_offsets) - 1):
+            analysis.add_candidate(self.get_path(path_id))
+        ports = set(self.calls['port'])
+        ports.update(value for kind, value in zip(self.extras['kind'], self.extras['value']) if kind == PORT)
+        analysis.ports = set(str(port) for port in ports if port != -1)
+        if self.times is not None and any(time >= 0 for time in self.times):
+            for call in self.iter_calls():
+                process = PROCESS_PATTERN.match(call)
+                if process is not None:
+                    analysis.feed_process(call, int(process.group(1)), float(process.group(2)), process.group(3))
+        return analysis
+
+    # Iterate over the archived system calls, formatted as trace log lines
+    def iter_calls(self):
+        extra = 0
+        for index in range(len(self.calls['pid'])):
+            references = [(kind, self.calls[CALL_COLUMNS[kind + 2]][index]) for kind in [QUOTED, DECODED, PORT]]
+            while extra < len(self.extras['call']) and self.extras['call'][extra] == index:
+                references.append((self.extras['kind'][extra], self.extras['value'][extra]))
+                extra += 1
+            syscall = self.get_syscall(self.calls['syscall'][index])
+            arguments = [f'"{self.get_path(value)}"' for kind, value in references if kind == QUOTED and value != -1]
+            if syscall == 'execve' and len(arguments) != 0: # The filename is followed by the arguments of the command
+                arguments = [arguments[0], f'[{", ".join(arguments[1:])}]']
+            arguments += [f'3<{self.get_path(value)}>' for kind, value in references if kind == DECODED and value != -1]
+            arguments += [f'{{sa_family=AF_INET, sin_port=htons({value})}}' for kind, value in references if kind == PORT and value != -1]
+            time = f' {self.times[index]:.6f}' if self.times is not None and self.times[index] >= 0 else ''
+            result = self.calls['result'][index] if 'result' in self.calls and self.calls['result'][index] != -1 else (0 if syscall not in PROCESS_SYSCALLS else '?')
+            yield f'{self.calls["pid"][index]}{time} {syscall}({", ".join(arguments)}) = {result}'
+
+# Convert a trace log into a trace archive
+def text_to_archive(trace_log, archive_path):
+    writer = TraceArchiveWriter()
+    with open(trace_log, 'r') as log:
+        for call in log:
+            writer.add(call)
+    writer.write(archive_path)
+
+# Convert a trace archive into a trace log
+def archive_to_text(archive_path, trace_log):
+    with TraceArchive.open(archive_path) as archive, open(trace_log, 'w') as log:
+        for call in archive.iter_calls():
+            log.write(call + '\n')
@@ -0,0 +1,116 @@
+import inspect
+import shlex
+
+# Commands used to trace the system calls of a target (timed traces also include process calls, with timestamps)
+STRACE_COMMAND = 'strace --follow-forks --decode-fds=path --trace=%file,%network --string-limit=999 --quiet=all --successful-only'
+TIMED_STRACE_COMMAND = 'strace --follow-forks --decode-fds=path --trace=%file,%network,%process --string-limit=999 --quiet=all --successful-only -ttt'
+
+# System calls that reference the paths and ports that are parsed from traces (? skips those the architecture does not have)
+SECCOMP_SYSCALLS = ['?open', 'openat', '?openat2', '?creat', '?stat', '?lstat', '?newfstatat', '?statx', '?access', 'faccessat', '?faccessat2',
+                    '?readlink', 'readlinkat', 'execve', '?execveat', 'connect', '?bind', '?sendto', '?sendmsg', '?sendmmsg']
+TIMED_SECCOMP_SYSCALLS = SECCOMP_SYSCALLS + ['%process']
+
+# Environment variable that tells the audit hook where to write its trace
+AUDIT_LOG_VARIABLE = 'AUDIT_TRACE_LOG'
+
+# Retrieve the command used to trace a target with strace
+def get_strace_command(timing=False):
+    return TIMED_STRACE_COMMAND if timing else STRACE_COMMAND
+
+# Retrieve the bash command that runs a target (or a script read from stdin)
+def get_bash_command(target=None):
+    return f'bash {target}' if target is not None else 'bash -s'
+
+# Class that traces targets with strace over every file and network system call
+class StraceBackend:
+    def __init__(self, timing=False):
+        self.timing = timing
+
+    # Retrieve the command that runs a target and writes its trace to output
+    def get_command(self, output, target=None):
+        return f'{get_strace_command(self.timing)} --output={output} {get_bash_command(target)}'
+
+# Class that traces targets with strace, filtering system calls in the kernel (seccomp-bpf) to those that are parsed
+# - Untraced system calls no longer stop the target, which removes most of the overhead of ptrace
+class SeccompStraceBackend(StraceBackend):
+    def get_command(self, output, target=None):
+        syscalls = ','.join(TIMED_SECCOMP_SYSCALLS if self.timing else SECCOMP_SYSCALLS)
+        timestamps = ' -ttt' if self.timing else ''
+        return (f'strace --seccomp-bpf --follow-forks --decode-fds=path --trace={syscalls} --string-limit=999 --quiet=all --successful-only{timestamps}'
+                f' --output={output} {get_bash_command(target)}')
+
+# Record the files opened, the modules imported and the sockets used by a python process, as strace-like lines
+# - Installed as sitecustomize, so imports are local and the source of this function is written out as is
+def audit_trace():
+    import atexit
+    import os
+    import sys
+
+    path = os.environ.get('AUDIT_TRACE_LOG')
+    if path is None:
+        return
+    log = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644) # Opened before the hook is added, and written with os.write, which is not audited
+
+    def write_path(file):
+        os.write(log, f'{os.getpid()} openat(AT_FDCWD, "{os.path.abspath(file)}", O_RDONLY) = 3\n'.encode('utf-8', 'surrogateescape'))
+
+    def hook(event, args):
+        if event == 'open':
+            if isinstance(args[0], (str, bytes)):
+                write_path(os.fsdecode(args[0]))
+        elif event == 'import':
+            if isinstance(args[1], str):
+                write_path(args[1])
+        elif event in ['socket.connect', 'socket.bind', 'socket.sendto']:
+            address = args[1]
+            if isinstance(address, tuple) and len(address) >= 2 and isinstance(address[1], int):
+                syscall = event.split('.')[1]
+                os.write(log, f'{os.getpid()} {syscall}(3, {{sa_family=AF_INET, sin_port=htons({address[1]}), sin_addr=inet_addr("{address[0]}")}}, 16) = 0\n'.encode())
+
+    # Modules imported before the hook was added, or loaded without an audited open (e.g. extension modules), are written on exit
+    def write_modules():
+        for module in list(sys.modules.values()):
+            file = getattr(module, '__file__', None)
+            if isinstance(file, str):
+                write_path(file)
+
+    sys.addaudithook(hook)
+    atexit.register(write_modules)
+
+# Import the sitecustomize module (if any) that the audit hook's sitecustomize hides
+def load_sitecustomize(hook_dir):
+    import importlib.machinery
+    import importlib.util
+    import sys
+    sys.path = [path for path in sys.path if path != hook_dir]
+    spec = importlib.machinery.PathFinder.find_spec('sitecustomize', sys.path)
+    if spec is not None:
+        spec.loader.exec_module(importlib.util.module_from_spec(spec))
+
+# Class that traces python targets with an audit hook (sys.addaudithook) injected as sitecustomize
+# - Files opened, modules imported and sockets connected, bound or sent to are recorded, as strace would record them
+# - Only python processes are traced, but at a fraction of the cost of ptrace (timing is not supported)
+class AuditHookBackend:
+    def __init__(self, timing=False):
+        self.timing = False # Processes are not traced, so commands cannot be timed
+
+    # Retrieve the source of the sitecustomize module that installs the audit hook
+    def get_sitecustomize(self):
+        functions = [audit_trace, load_sitecustomize]
+        return '\n'.join([inspect.getsource(function) for function in functions] + ['audit_trace()', 'load_sitecustomize(__file__.rsplit("/", 1)[0])'])
+
+    # Retrieve the command that runs a target and writes its trace to output (the hook is written to a temporary directory)
+    def get_command(self, output, target=None):
+        sitecustomize = shlex.quote(self.get_sitecustomize())
+        return (f'(hook=$(mktemp -d) && printf "%s" {sitecustomize} > "$hook/sitecustomize.py" && : > {output}'
+                f' && PYTHONPATH="$hook${{PYTHONPATH:+:$PYTHONPATH}}" {AUDIT_LOG_VARIABLE}={output} {get_bash_command(target)};'
+                f' status=$?; rm -rf "$hook"; exit $status)')
+
+# Tracing backends, by name
+BACKENDS = {'strace': StraceBackend, 'seccomp': SeccompStraceBackend, 'audit': AuditHookBackend}
+
+# Retrieve a tracing backend by name
+def get_backend(name='strace', timing=False):
+    if name not in BACKENDS:
+        raise ValueError(f'unknown tracing backend: {name} (expected one of {", ".join(BACKENDS)})')
+    return BACKENDS[name](timing)
@@ -0,0 +1,200 @@
+import argparse
+import copy
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+from environment import Environment, parse_docker_log
+from pathcheck import find_existing_paths
+from tracing import Tracing, TraceAnalysis
+
+# Syscalls used when generating synthetic traces
+FILE_SYSCALLS = ['openat', 'newfstatat', 'access', 'readlink', 'stat']
+PYTHON_VERSIONS = ['3.8', '3.9', '3.10', '3.11', '3.12']
+
+#========================================================================================================
+#                                        GENERATE SYNTHETIC INPUTS
+#========================================================================================================
+
+# Generate a synthetic site-packages with installed distributions, returning its pip inventory and distribution records
+def generate_inventory(root, packages=200, files=20, version='3.11'):
+    site_packages = f'{root}/usr/lib/python{version}/site-packages'
+    installed = {}
+    records = []
+    for i in range(packages):
+        name = f'package-{i}'
+        module = f'package_{i}'
+        os.makedirs(f'{site_packages}/{module}', exist_ok=True)
+        recorded = []
+        for j in range(files):
+            with open(f'{site_packages}/{module}/module_{j}.py', 'w') as file:
+                file.write('')
+            recorded.append(f'{module}/module_{j}.py')
+        installed[name] = f'1.{i}.0'
+        records.append({'name': name, 'version': installed[name], 'root': site_packages, 'top_level': [module], 'files': recorded})
+    return site_packages, installed, records
+
+# Generate a synthetic trace log (the mix gives the proportion of path, port and python calls)
+def generate_trace_log(path, lines, site_packages, packages=200, files=20, mix=(0.8, 0.05, 0.15), seed=0):
+    generator = random.Random(seed)
+    python_paths = [f'/usr/lib/python{version}/os.py' for version in PYTHON_VERSIONS]
+    with open(path, 'w') as log:
+        for _ in range(lines):
+            pid = generator.randint(1000, 1100)
+            kind = generator.random()
+            if kind < mix[0]:
+                traced = f'{site_packages}/package_{generator.randrange(packages)}/module_{generator.randrange(files)}.py'
+                if generator.random() < 0.3:
+                    traced = f'/tmp/missing/{generator.randrange(10000)}/file.py' # Paths that do not exist
+                log.write(f'{pid} {generator.choice(FILE_SYSCALLS)}(AT_FDCWD, "{traced}", O_RDONLY|O_CLOEXEC) = 3</{traced.lstrip("/")}>\n')
+            elif kind < mix[0] + mix[1]:
+                log.write(f'{pid} connect(3<socket:[{pid}]>, {{sa_family=AF_INET, sin_port=htons({generator.choice([80, 443, 5432, 6379, 8080])}), sin_addr=inet_addr("127.0.0.1")}}, 16) = 0\n')
+            else:
+                log.write(f'{pid} openat(AT_FDCWD, "{generator.choice(python_paths)}", O_RDONLY|O_CLOEXEC) = 3\n')
+
+# Generate a synthetic docker log
+# - Docker Log == docker ps --no-trunc --format "{{.ID}}~{{.Names}}~{{.Image}}~{{.Ports}}"
+def generate_docker_log(path, containers=20):
+    with open(path, 'w') as log:
+        for i in range(containers):
+            log.write(f'{i:064x}~service-{i}~image-{i}:latest~0.0.0.0:{5000 + i}->{5000 + i}/tcp\n')
+
+# Generate a synthetic target that runs a script per line
+def generate_target(path, commands=10, containers=20):
+    with open(path, 'w') as target:
+        target.write('home=$PWD\ncd $(dirname "$0")\n')
+        for i in range(commands):
+            target.write(f'docker exec {i % containers:064x} python3 test_{i}.py > /dev/null 2>&1\n' if i % 3 == 0 else f'python3 test_{i}.py > /dev/null 2>&1\n')
+        target.write('cd $home\n')
+
+#========================================================================================================
+#                                        BENCHMARK PIPELINE PHASES
+#========================================================================================================
+
+# Time a function (the best of several repeats) and return its last result
+def measure(results, name, function, repeat=1):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results[name] = best
+    print(f'{name}: {best:.4f}s', file=sys.stderr)
+    return result
+
+# Refuse to spawn subprocesses, so that benchmarks never trace or query the real system
+def refuse_subprocess(*args, **kwargs):
+    raise RuntimeError(f'benchmarks run offline, but a subprocess was spawned: {args}')
+
+# Benchmark the parse phases of Tracing on a synthetic trace log
+def benchmark_tracing(results, directory, lines, repeat):
+    site_packages, installed, records = generate_inventory(directory)
+    trace_log, paths_log, docker_log = f'{directory}/trace.log', f'{directory}/paths.log', f'{directory}/docker.log'
+    generate_trace_log(trace_log, lines, site_packages)
+    generate_docker_log(docker_log)
+    generate_target(f'{directory}/target.sh')
+    environment = Environment('benchmark', installed, [site_packages], records, parse_docker_log(docker_log), None)
+
+    with mock.patch.object(subprocess, 'run', refuse_subprocess), mock.patch.object(subprocess, 'Popen', refuse_subprocess):
+        analysis = measure(results, f'tracing.analysis@{lines}', lambda: TraceAnalysis.from_log(trace_log), repeat)
+        measure(results, f'tracing.paths@{lines}', lambda: find_existing_paths(analysis.candidates), repeat)
+        def construct():
+            if os.path.exists(paths_log):
+                os.remove(paths_log)
+            return Tracing(target=f'{directory}/target.sh', trace_log=trace_log, paths_log=paths_log, docker_log=docker_log,
+                           requirements_log=f'{directory}/requirements.txt', environment=environment)
+        tracing = measure(results, f'tracing.total@{lines}', construct, repeat)
+        tracing.analysis = analysis
+        measure(results, f'tracing.versions@{lines}', tracing.parse_versions, repeat)
+        def parse_candidates():
+            environment.index = None # Include building the distribution index
+            return tracing.parse_candidates()
+        measure(results, f'tracing.candidates@{lines}', parse_candidates, repeat)
+        measure(results, f'tracing.requirements@{lines}', lambda: tracing.parse_requirements(None), repeat)
+        measure(results, f'tracing.ports@{lines}', tracing.parse_ports, repeat)
+    return tracing
+
+# Benchmark YamlCI construction and dumping across many jobs
+def benchmark_yamlci(results, directory, tracing, jobs, repeat):
+    from yamlci import YamlCI
+    def construct():
+        tracings = []
+        for i in range(jobs):
+            job_tracing = copy.copy(tracing)
+            job_tracing.target = f'target_{i}.sh'
+            job_tracing.scripts = list(tracing.scripts) # Scripts are rewritten during construction
+            tracings.append(job_tracing)
+        return YamlCI(tracings)
+    ciyaml = measure(results, f'yamlci.construct@{jobs}', construct, repeat)
+    measure(results, f'yamlci.dump@{jobs}', lambda: ciyaml.dump(f'{directory}/workflow.yaml'), repeat)
+    return f'{directory}/workflow.yaml'
+
+# Benchmark evaluation metrics on a generated workflow and a perturbed copy of it
+def benchmark_evaluate(results, directory, reference_path, repeat):
+    import evaluate
+    with open(reference_path, 'r') as file:
+        reference = file.read()
+    hypothesis = reference.replace('ubuntu-latest', 'ubuntu-22.04').replace('python3 test_1', 'python3 test_one')
+    hypothesis_path = f'{directory}/hypothesis.yaml'
+    with open(hypothesis_path, 'w') as file:
+        file.write(hypothesis)
+    measure(results, 'evaluate.shared_lines', lambda: evaluate.calc_shared_lines(reference, hypothesis), repeat)
+    measure(results, 'evaluate.structural_edits', lambda: evaluate.calc_num_of_edits(reference_path, hypothesis_path, engine='structural'), repeat)
+    _, engine = measure(results, 'evaluate.auto_edits', lambda: evaluate.calc_num_of_edits(reference_path, hypothesis_path), repeat) # The default, which diffs with graphtage
+    if engine != 'graphtage':
+        print(f'evaluate.auto_edits: graphtage exceeded its budget, so the {engine} engine was timed', file=sys.stderr)
+    measure(results, 'evaluate.code_bleu', lambda: evaluate.calc_code_bleu(evaluate.yaml_to_javascript(reference_path), evaluate.yaml_to_javascript(hypothesis_path), 'javascript'), repeat)
+
+#========================================================================================================
+#                                        COMPARE AGAINST BASELINES
+#========================================================================================================
+
+# Find the phases that are slower than their baseline by more than the tolerance (e.g. 0.25 == 25%)
+def find_regressions(results, baseline, tolerance):
+    return {name: (baseline[name], elapsed) for name, elapsed in results.items()
+            if name in baseline and elapsed > baseline[name] * (1 + tolerance)}
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', dest='lines', type=int, nargs='+', help='sizes of the synthetic trace logs (e.g. 1000 100000 10000000)', default=[1000, 100000])
+    parser.add_argument('--jobs', dest='jobs', type=int, help='number of jobs in the generated workflows', default=100)
+    parser.add_argument('--phases', dest='phases', nargs='+', choices=['tracing', 'yamlci', 'evaluate'], help='pipeline phases to benchmark (yamlci and evaluate require ruamel.yaml, codebleu and graphtage)', default=['tracing', 'yamlci', 'evaluate'])
+    parser.add_argument('--repeat', dest='repeat', type=int, help='number of times each phase is timed (the best time is kept)', default=3)
+    parser.add_argument('--baseline', dest='baseline', type=str, help='path to a baseline to compare results against', default=None)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help='slowdown, relative to the baseline, that is reported as a regression', default=0.25)
+    parser.add_argument('--save', dest='save', type=str, help='path for the results, which can be used as a baseline', default=None)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        # Later phases are run on the results of the earlier phases (which are generated, but not timed, when they are skipped)
+        tracing = None
+        for lines in args.lines if 'tracing' in args.phases else [min(args.lines)]:
+            os.makedirs(f'{directory}/{lines}')
+            tracing = benchmark_tracing(results if 'tracing' in args.phases else {}, f'{directory}/{lines}', lines, args.repeat)
+        if 'yamlci' in args.phases or 'evaluate' in args.phases:
+            workflow = benchmark_yamlci(results if 'yamlci' in args.phases else {}, directory, tracing, args.jobs, args.repeat)
+        if 'evaluate' in args.phases:
+            benchmark_evaluate(results, directory, workflow, args.repeat)
+
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=4)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            regressions = find_regressions(results, json.load(file), args.tolerance)
+        for name, (baseline, elapsed) in regressions.items():
+            print(f'regression in {name}: {baseline:.4f}s -> {elapsed:.4f}s', file=sys.stderr)
+        if len(regressions) != 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
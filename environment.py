@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+import agent
+from resolver import DistributionIndex, load_python_packages, read_module_path_mtimes
+
+# Parse pip requirements (e.g. pip freeze output or a requirements log) into {module: version}
+def parse_modules(lines):
+    modules = {}
+    for module in lines:
+        if module.strip() == '':
+            continue
+        module_parsed = {module: ''}
+        if any(delim in module for delim in ['<','>','=']):
+            module_split = re.split('[<>=]', module, 1)
+            module_parsed = {module_split[0].strip(): module_split[1].strip()[1:]}
+        modules.update(module_parsed)
+    return modules
+
+# Parse docker information from the docker log
+# - Docker Log == docker ps --no-trunc --format "{{.ID}}~{{.Names}}~{{.Image}}~{{.Ports}}"
+def parse_docker_log(docker_log):
+    # Find open the docker log and extract its container information
+    if not os.path.exists(docker_log):
+        return []
+    with open(docker_log, 'r') as log:
+        containers = list(log.read().splitlines())
+
+    # Parse containers into the following format: [[container_id-1, container_name-1, image:version-1, ['host-port-1:container:port-1', ...]]]
+    containers = [container.split('~') for container in containers]
+    containers = [container if container[3] != '' else [container[0], container[1], container[2], 'None/tcp'] for container in containers]
+    containers = [[container[0], container[1], container[2], [re.findall("(?<=:).*", port)[0].replace("->",":") if "->" in port else '{0}:{1}'.format(re.findall(".+?(?=\\/)", port)[0], port)
+            for port in container[3].split(', ', 1)]] for container in containers]
+    containers = [{'id': container[0], 'name': container[1], 'image': container[2], 'ports': container[3]} for container in containers]
+    return containers
+
+# Parse the id of the docker container that this process runs in (or None if it does not run in a container)
+def parse_cgroup_container():
+    if not os.path.exists('/proc/self/cgroup'):
+        return None
+    with open('/proc/self/cgroup', 'r') as cgroup:
+        container_ids = re.findall("(?<=name=systemd:\\/docker\\/).*", cgroup.read())
+    return container_ids[0].strip() if len(container_ids) != 0 else None
+
+# Class that captures the environment targets are traced in, so that it can be shared across targets and runs
+class Environment:
+    def __init__(self, fingerprint, installed, module_paths, distributions, docker, container_id):
+        self.fingerprint = fingerprint
+        self.installed = installed # Modules installed on the system (or host container), i.e. pip freeze
+        self.module_paths = module_paths
+        self.distributions = distributions # Distribution records used to resolve paths to modules
+        self.docker = docker # Containers listed in the docker log
+        self.container_id = container_id # Container that the tracing runs in
+        self.index = None
+
+    # Capture the environment with the required subprocesses
+    @classmethod
+    def capture(cls, host_container=None, docker_log='docker.log', fingerprint=None):
+        if host_container is not None:
+            helper = agent.connect(host_container)
+            requests = [helper.submit('python_packages'), helper.submit('pip_freeze')] # Pipelined through the container's helper agent
+            packages, installed = [helper.result(request) for request in requests]
+        else:
+            packages = load_python_packages()
+            installed = subprocess.run('pip freeze', shell=True, capture_output=True, text=True).stdout
+        return cls(fingerprint if fingerprint is not None else get_fingerprint(host_container, docker_log),
+                   parse_modules(installed.splitlines()),
+                   packages['module_paths'],
+                   packages['distributions'],
+                   parse_docker_log(docker_log),
+                   parse_cgroup_container())
+
+    # Load the environment snapshot with a matching fingerprint (or capture and save it if it does not exist)
+    @classmethod
+    def load(cls, host_container=None, docker_log='docker.log', snapshot_dir='.environment', new_env=False):
+        fingerprint = get_fingerprint(host_container, docker_log)
+        snapshot = f'{snapshot_dir}/{fingerprint}.json'
+        if not new_env and os.path.exists(snapshot):
+            with open(snapshot, 'r') as file:
+                return cls(**json.load(file))
+        environment = cls.capture(host_container, docker_log, fingerprint)
+        environment.save(snapshot)
+        return environment
+
+    # Write the environment snapshot to a file
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fields = {'fingerprint': self.fingerprint,
+                  'installed': self.installed,
+                  'module_paths': self.module_paths,
+                  'distributions': self.distributions,
+                  'docker': self.docker,
+                  'container_id': self.container_id}
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(fields, file)
+        os.replace(f'{path}.tmp', path)
+
+    # Retrieve the index that maps paths to their installed distributions (built once per environment)
+    def get_index(self):
+        if self.index is None:
+            self.index = DistributionIndex(self.distributions)
+        return self.index
+
+# Fingerprint the environment without running pip or reading package metadata
+# - Modification times of the python package paths (changed when modules are installed or removed), read by the helper agent of a host container
+# - The host container's id, the docker log and the cgroup of this process
+def get_fingerprint(host_container=None, docker_log='docker.log'):
+    fingerprint = hashlib.sha256()
+    fingerprint.update(f'container:{host_container}\n'.encode())
+    mtimes = read_module_path_mtimes() if host_container is None else agent.connect(host_container).request('module_path_mtimes')
+    for path, mtime in mtimes.items():
+        fingerprint.update(f'path:{path}:{mtime}\n'.encode())
+    for path in [docker_log, '/proc/self/cgroup']:
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                fingerprint.update(file.read())
+    return fingerprint.hexdigest()[:16]
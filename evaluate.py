@@ -1,55 +1,190 @@
 import argparse
+import difflib
+import functools
+import hashlib
 import json
 import os
 import itertools
+import signal
+import sqlite3
+import sys
+import threading
 import ruamel.yaml
 import codebleu
 import graphtage
 import matplotlib.pyplot as plt
 from datetime import datetime
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Versions of each metric (cached values of a metric are recomputed when its version changes)
+METRIC_VERSIONS = {'code_bleu': 1, 'shared_lines': 1, 'num_of_edits': 2}
 
 def calc_shared_lines(reference: str, hypothesis: str) -> float:
     """Caclulate the proportion of shared lines between strings (ignoring leading/trailing whitespace and order)"""
-    reference_lines = [line.strip() for line in reference.splitlines()]
-    hypothesis_lines = [line.strip() for line in hypothesis.splitlines()]
-    exact_matches = len([None for line in reference_lines if line in hypothesis_lines and not hypothesis_lines.remove(line)])
-    accuracy = exact_matches / len(reference_lines)
+    reference_lines = Counter(line.strip() for line in reference.splitlines())
+    hypothesis_lines = Counter(line.strip() for line in hypothesis.splitlines())
+    exact_matches = sum((reference_lines & hypothesis_lines).values())
+    accuracy = exact_matches / sum(reference_lines.values())
     return accuracy
 
-def calc_num_of_edits(reference_path: str, hypothesis_path: str) -> int:
-    """Number of differences resulting from a semantic diff between the reference and hypothesis"""
-    reference_tree = graphtage.yaml.build_tree(reference_path)
-    hypothesis_tree = graphtage.yaml.build_tree(hypothesis_path)
-    edits = list(reference_tree.get_all_edits(hypothesis_tree))
-    return len(edits)
+class DiffBudgetExceeded(Exception):
+    """Raised when a semantic diff exceeds its time budget"""
+
+def raise_diff_budget_exceeded(signum, frame):
+    raise DiffBudgetExceeded()
+
+def calc_graphtage_edits(reference_path: str, hypothesis_path: str, time_budget: float = None) -> int:
+    """Number of differences resulting from graphtage's semantic diff (interrupted after time_budget seconds, if given)"""
+    timed = time_budget is not None and threading.current_thread() is threading.main_thread() # Timers can only interrupt the main thread
+    if timed:
+        previous_handler = signal.signal(signal.SIGALRM, raise_diff_budget_exceeded)
+        signal.setitimer(signal.ITIMER_REAL, time_budget)
+    try:
+        reference_tree = graphtage.yaml.build_tree(reference_path)
+        hypothesis_tree = graphtage.yaml.build_tree(hypothesis_path)
+        return sum(1 for _ in reference_tree.get_all_edits(hypothesis_tree))
+    finally:
+        if timed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+def calc_structural_edits(reference, hypothesis) -> int:
+    """Number of differences between parsed YAMLs, matching mappings by key and aligning sequences"""
+    if isinstance(reference, dict) and isinstance(hypothesis, dict):
+        edits = 0
+        for key in reference.keys() | hypothesis.keys():
+            if key not in reference or key not in hypothesis:
+                edits += 1
+            else:
+                edits += calc_structural_edits(reference[key], hypothesis[key])
+        return edits
+    if isinstance(reference, list) and isinstance(hypothesis, list):
+        edits = 0
+        matcher = difflib.SequenceMatcher(None, [canonicalize(item) for item in reference], [canonicalize(item) for item in hypothesis], autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'replace': # Replaced items are compared pairwise, and any surplus items are inserted or deleted
+                edits += sum(calc_structural_edits(item, other) for item, other in zip(reference[i1:i2], hypothesis[j1:j2]))
+                edits += abs((i2 - i1) - (j2 - j1))
+            elif tag != 'equal':
+                edits += (i2 - i1) + (j2 - j1)
+        return edits
+    return 0 if reference == hypothesis else 1
+
+def calc_num_of_edits(reference_path: str, hypothesis_path: str, engine: str = 'auto', time_budget: float = 60.0, size_budget: int = 20000) -> tuple[int, str]:
+    """Number of differences resulting from a semantic diff between the reference and hypothesis, and the engine that produced it
+    (auto: graphtage, unless the YAMLs have more than size_budget nodes or the diff takes more than time_budget seconds, then structural)"""
+    if engine == 'graphtage':
+        return calc_graphtage_edits(reference_path, hypothesis_path), 'graphtage'
+    reference, hypothesis = parse_yaml(reference_path), parse_yaml(hypothesis_path)
+    if engine == 'auto' and count_nodes(reference) + count_nodes(hypothesis) <= size_budget:
+        try:
+            return calc_graphtage_edits(reference_path, hypothesis_path, time_budget), 'graphtage'
+        except DiffBudgetExceeded:
+            pass
+    return calc_structural_edits(reference, hypothesis), 'structural'
 
 def calc_code_bleu(reference: str, hypothesis: str, lang: str) -> dict[str, float]:
     """Calculate the BLEU score for a hypothesis string given a reference string"""
     code_bleu = codebleu.calc_codebleu([reference], [hypothesis], lang=lang, weights=(0.25, 0.25, 0.25, 0.25), tokenizer=None)
     return code_bleu
 
-def complete_evaluation(reference_path: str, hypothesis_path: str):
+def complete_evaluation(reference_path: str, hypothesis_path: str, diff_options: dict = {}):
     """Conduct all available evaluations on the given hypothesis"""
-    reference_path = reference_path
-    hypothesis_path = hypothesis_path
-    with open(reference_path, 'r') as yaml:
-        reference_yaml = yaml.read()
-    with open(hypothesis_path, 'r') as yaml:
-        hypothesis_yaml = yaml.read()
-    reference_js = yaml_to_javascript(reference_path)
-    hypothesis_js = yaml_to_javascript(hypothesis_path)
-
-    shared_lines = calc_shared_lines(reference_yaml, hypothesis_yaml)
-    code_bleu = calc_code_bleu(reference_js, hypothesis_js, 'javascript')
-    num_of_edits = calc_num_of_edits(reference_path, hypothesis_path)
-    result = {**code_bleu, **{'shared_lines': shared_lines, 'num_of_edits': num_of_edits}}
-    return result
+    return combine_metrics(evaluate_metrics(reference_path, hypothesis_path, diff_options=diff_options))
+
+def evaluate_metrics(reference_path: str, hypothesis_path: str, metrics: list[str] = list(METRIC_VERSIONS), diff_options: dict = {}) -> dict:
+    """Conduct the given evaluations on the given hypothesis, keyed by metric (diff_options are passed to calc_num_of_edits)"""
+    values = {}
+    if 'code_bleu' in metrics:
+        values['code_bleu'] = calc_code_bleu(load_javascript(reference_path), load_javascript(hypothesis_path), 'javascript')
+    if 'shared_lines' in metrics:
+        values['shared_lines'] = calc_shared_lines(read_yaml(reference_path), read_yaml(hypothesis_path))
+    if 'num_of_edits' in metrics:
+        values['num_of_edits'] = calc_num_of_edits(reference_path, hypothesis_path, **diff_options)
+        if values['num_of_edits'][1] == 'structural' and diff_options.get('engine', 'auto') == 'auto': # Whether auto fell back for size, or for time
+            values['num_of_edits:nodes'] = count_nodes(parse_yaml(reference_path)) + count_nodes(parse_yaml(hypothesis_path))
+    return values
+
+def combine_metrics(values: dict) -> dict:
+    """Combine the values of every metric into a single evaluation result"""
+    num_of_edits, num_of_edits_engine = values['num_of_edits']
+    return {**values['code_bleu'], **{'shared_lines': values['shared_lines'], 'num_of_edits': num_of_edits, 'num_of_edits_engine': num_of_edits_engine}}
+
+@functools.lru_cache(maxsize=None)
+def read_yaml(path: str) -> str:
+    """Read a YAML (memoized, as a reference is shared by every hypothesis in its group)"""
+    with open(path, 'r') as yaml:
+        return yaml.read()
+
+@functools.lru_cache(maxsize=None)
+def load_javascript(path: str) -> str:
+    """Convert a YAML to javascript (memoized, as a reference is shared by every hypothesis in its group)"""
+    return yaml_to_javascript(path)
+
+def hash_yaml(path: str) -> str:
+    """Hash the content of a YAML"""
+    return hashlib.sha256(read_yaml(path).encode()).hexdigest()
+
+def get_cached_edits(cached: dict, diff_options: dict = {}):
+    """Cached edit count (and engine) for the diff options, or None if it has to be computed
+    (auto only reuses graphtage counts, and structural counts of YAMLs over its size budget, as time budget fallbacks depend on load)"""
+    options = {'engine': 'auto', 'size_budget': 20000, **diff_options}
+    if options['engine'] != 'auto':
+        return cached.get(f'num_of_edits:{options["engine"]}')
+    if 'num_of_edits:graphtage' in cached:
+        return cached['num_of_edits:graphtage']
+    if cached.get('num_of_edits:nodes', 0) > options['size_budget']:
+        return cached.get('num_of_edits:structural')
+    return None
+
+def get_cached_values(values: dict) -> dict:
+    """Names that computed values are cached under (edit counts are cached under the engine that produced them)"""
+    return {f'num_of_edits:{value[1]}' if metric == 'num_of_edits' else metric: value for metric, value in values.items()}
+
+class MetricCache:
+    """Persistent cache of metric values, keyed by the content of the reference and hypothesis and the metric's version"""
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS metrics (reference TEXT, hypothesis TEXT, metric TEXT, version INTEGER, value TEXT, '
+                                'PRIMARY KEY (reference, hypothesis, metric, version))')
+
+    def get(self, reference_hash: str, hypothesis_hash: str) -> dict:
+        """Retrieve the cached values of the current version of every metric"""
+        rows = self.connection.execute('SELECT metric, version, value FROM metrics WHERE reference = ? AND hypothesis = ?', (reference_hash, hypothesis_hash))
+        return {metric: json.loads(value) for metric, version, value in rows if METRIC_VERSIONS.get(metric.split(':')[0]) == version}
+
+    def put(self, reference_hash: str, hypothesis_hash: str, values: dict):
+        """Cache the values of the current version of the given metrics"""
+        rows = [(reference_hash, hypothesis_hash, metric, METRIC_VERSIONS[metric.split(':')[0]], json.dumps(value)) for metric, value in values.items()]
+        self.connection.executemany('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+@functools.lru_cache(maxsize=None)
+def parse_yaml(path: str):
+    """Parse a YAML into python objects (memoized, as a reference is shared by every hypothesis in its group)"""
+    with open(path, 'r') as file:
+        return ruamel.yaml.YAML(typ='safe').load(file)
+
+def canonicalize(value) -> str:
+    """Serialize parsed YAML so that equal values can be compared and hashed"""
+    return json.dumps(value, sort_keys=True, default=str)
+
+def count_nodes(value) -> int:
+    """Count the nodes of parsed YAML"""
+    if isinstance(value, dict):
+        return 1 + sum(count_nodes(key) + count_nodes(item) for key, item in value.items())
+    if isinstance(value, list):
+        return 1 + sum(count_nodes(item) for item in value)
+    return 1
 
 def yaml_to_javascript(path: str) -> str:
     """Convert YAML to javascript object and return dumped filename"""
-    with open(path, 'r') as file:
-        yaml = ruamel.yaml.YAML(typ='safe').load(file)
+    yaml = parse_yaml(path)
     jsons = json.dumps(yaml, separators=(',', ':'))
     javascript = 'const object = ' + jsons.replace('\n', '; ')
     return javascript
@@ -58,20 +193,84 @@ def load_batch(path: str):
     """Load all YAMLs that are within file structures with the following format: path/repo_name/version.yaml"""
     return {os.path.basename(dirpath): list(map(lambda filename: f'{dirpath}/{filename}', filenames)) for dirpath, _, filenames in os.walk(path) if filenames}
 
-def evaluate_batch(batch: dict[str, list[str]], reference_name: str):
-    """Conduct complete evaluation on YAMLs within batch on their respective references"""
-    result = {}
+def list_batch_pairs(batch: dict[str, list[str]], reference_name: str) -> list[tuple[str, str, str, str]]:
+    """List the (group, version, reference path, hypothesis path) of every hypothesis within batch"""
+    pairs = []
     for group, files in batch.items():
         for hypothesis_path in files:
             basename = os.path.basename(hypothesis_path)
             if basename == reference_name:
                 continue
             reference_path = f'{os.path.dirname(hypothesis_path)}/{reference_name}'
-            if group not in result:
-                result[group] = {}
-            result[group][basename] = complete_evaluation(reference_path, hypothesis_path)
+            pairs.append((group, basename, reference_path, hypothesis_path))
+    return pairs
+
+def evaluate_pair(reference_path: str, hypothesis_path: str, metrics: list[str] = list(METRIC_VERSIONS), diff_options: dict = {}) -> tuple[dict, str]:
+    """Conduct the given evaluations on a hypothesis, returning the error instead of raising it"""
+    try:
+        return evaluate_metrics(reference_path, hypothesis_path, metrics, diff_options), None
+    except Exception as error:
+        return None, f'{type(error).__name__}: {error}'
+
+def evaluate_batch(batch: dict[str, list[str]], reference_name: str, workers: int = 1, cache: MetricCache = None, diff_options: dict = {}):
+    """Conduct complete evaluation on YAMLs within batch on their respective references (across worker processes if workers > 1)"""
+    # Only evaluate the metrics that have not been cached for the content of each pair (pairs that cannot be read have failed)
+    pairs = list_batch_pairs(batch, reference_name)
+    hashes = [None] * len(pairs)
+    values = [{} for _ in pairs]
+    errors = [None] * len(pairs)
+    for i, (group, basename, reference_path, hypothesis_path) in enumerate(pairs if cache is not None else []):
+        try:
+            hashes[i] = (hash_yaml(reference_path), hash_yaml(hypothesis_path))
+        except Exception as error:
+            errors[i] = f'{type(error).__name__}: {error}'
+            print(f'{group}/{basename}: failed ({errors[i]})', file=sys.stderr)
+            continue
+        cached = cache.get(*hashes[i])
+        values[i] = {metric: cached[metric] for metric in METRIC_VERSIONS if metric != 'num_of_edits' and metric in cached}
+        if get_cached_edits(cached, diff_options) is not None:
+            values[i]['num_of_edits'] = get_cached_edits(cached, diff_options)
+    pending = [(i, [metric for metric in METRIC_VERSIONS if metric not in values[i]]) for i in range(len(pairs)) if errors[i] is None]
+    pending = [(i, metrics) for i, metrics in pending if len(metrics) != 0]
+
+    def complete(i: int, evaluation: tuple[dict, str], completed: int):
+        computed, errors[i] = evaluation
+        if computed is not None:
+            values[i].update(computed)
+            if cache is not None:
+                cache.put(*hashes[i], get_cached_values(computed))
+        report_progress(completed, pairs[i], evaluation, len(pending))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(evaluate_pair, pairs[i][2], pairs[i][3], metrics, diff_options): i for i, metrics in pending}
+            for completed, future in enumerate(as_completed(futures), 1):
+                try:
+                    evaluation = future.result()
+                except Exception as error: # e.g. BrokenProcessPool when a worker is killed, which fails every pair that has not completed
+                    evaluation = None, f'{type(error).__name__}: {error}'
+                complete(futures[future], evaluation, completed)
+    else:
+        for completed, (i, metrics) in enumerate(pending, 1):
+            complete(i, evaluate_pair(pairs[i][2], pairs[i][3], metrics, diff_options), completed)
+
+    # Results are ordered as they would be by a serial evaluation, and failed evaluations are left out
+    result = {}
+    for (group, basename, _, _), pair_values, error in zip(pairs, values, errors):
+        if error is not None:
+            continue
+        if group not in result:
+            result[group] = {}
+        result[group][basename] = combine_metrics(pair_values)
     return result
 
+def report_progress(completed: int, pair: tuple[str, str, str, str], evaluation: tuple[dict, str], total: int):
+    """Report the progress of a batch evaluation (and the error of a failed evaluation)"""
+    group, basename, _, _ = pair
+    _, error = evaluation
+    status = 'done' if error is None else f'failed ({error})'
+    print(f'[{completed}/{total}] {group}/{basename}: {status}', file=sys.stderr)
+
 def organize_batch_result(batch_result: dict, dump: bool = False):
     """Parse batch result to produce something that is easier to plot"""
     metrics = list(list(list(batch_result.values())[0].values())[0].keys())
@@ -89,7 +288,7 @@ def organize_batch_result(batch_result: dict, dump: bool = False):
 
 def plot_batch_result(organized_result: dict, rows: int = 2, cols: int = 4, order: list = None):
     """Plot organized batch results"""
-    results = organized_result
+    results = {metric: yamls for metric, yamls in organized_result.items() if all(isinstance(value, (int, float)) for values in yamls.values() for value in values)} # e.g. not engines
     versions: list[str] = list(list(list(results.values())[0].keys()))
     if order is not None and set(versions) == set(order):
         versions = order
@@ -116,11 +315,18 @@ def parse_args():
     parser.add_argument('--batch', dest='batch_info', nargs="2", help='Batch evaluation using a directory of sub-directories that contain YAMLs')
     parser.add_argument('--save', dest='save', help='Whether evaluation logs should be saved', action='store_true')
     parser.add_argument('--plot', dest='plot_path', type=str, help='Plot an existing evaluation log')
+    parser.add_argument('--workers', dest='workers', type=int, help='Number of worker processes used for batch evaluation', default=1)
+    parser.add_argument('--cache', dest='cache_path', type=str, help='Path to, or for, a cache of evaluation results', default='.evaluation_cache.sqlite')
+    parser.add_argument('--no_cache', dest='no_cache', help='Whether cached evaluation results should be ignored', action='store_true')
+    parser.add_argument('--edit_engine', dest='edit_engine', choices=['auto', 'graphtage', 'structural'], help='Diff engine used to count edits', default='auto')
+    parser.add_argument('--edit_time_budget', dest='edit_time_budget', type=float, help='Seconds that graphtage may take to count edits before falling back (auto engine)', default=60.0)
+    parser.add_argument('--edit_size_budget', dest='edit_size_budget', type=int, help='Maximum number of YAML nodes diffed with graphtage (auto engine)', default=20000)
     parser.add_argument('--order', dest='plot_order', nargs="+", help='Order to plot the YAMLs in a batch directory')
     return parser.parse_args()
 
 def main():
     args = parse_args()
+    diff_options = {'engine': args.edit_engine, 'time_budget': args.edit_time_budget, 'size_budget': args.edit_size_budget}
 
     if args.plot_path:
         with open(args.plot_path, 'r') as file:
@@ -129,12 +335,15 @@ def main():
     elif args.batch_info:
         batch_path, reference_filename = args.batch_info[0], args.batch_info[1]
         batch = load_batch(batch_path)
-        batch_result = evaluate_batch(batch, reference_filename)
+        cache = MetricCache(args.cache_path) if not args.no_cache else None
+        batch_result = evaluate_batch(batch, reference_filename, args.workers, cache, diff_options)
+        if cache is not None:
+            cache.close()
         organized_result = organize_batch_result(batch_result, args.save)
         plot_batch_result(organized_result, order=args.plot_order)
     elif args.single_paths:
         reference_path, hypothesis_path = args.single_paths[0], args.single_paths[1]
-        print(complete_evaluation(reference_path, hypothesis_path))
+        print(complete_evaluation(reference_path, hypothesis_path, diff_options))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
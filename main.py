@@ -1,5 +1,11 @@
 import argparse
-from tracing import Tracing
+import cProfile
+from concurrent.futures import ProcessPoolExecutor
+from archive import text_to_archive
+from environment import Environment
+import profiling
+from tracecache import TraceCache
+from tracing import Tracing, is_archive
 from yamlci import YamlCI
 import os
 
@@ -9,31 +15,114 @@ def parse_args():
     parser.add_argument('--host_container', dest='host_container', type=str, help='id of the container that the target is running in', default=None)
     parser.add_argument('--requirements', dest='requirements_log', type=str, help='path to a pip requirements file', default='requirements.txt')
     parser.add_argument('--workflow', dest='workflow', type=str, help='path to, or for, a workflow configuration', default='workflow.yaml')
-    parser.add_argument('--trace_log', dest='trace_log', type=str, help='path to, or for, a trace log', default='trace.log')
+    parser.add_argument('--trace_log', dest='trace_log', type=str, help='path to, or for, a trace log (an existing trace log given here is analyzed rather than traced again)', default=None)
     parser.add_argument('--paths_log', dest='paths_log', type=str, help='path to, or for, a path log', default='paths.log')
     parser.add_argument('--docker_log', dest='docker_log', type=str, help='path to a log listing the docker containers on the machine', default='docker.log')
     parser.add_argument('--workflow_name', dest='workflow_name', type=str, help='name for a new workflow configuration', default='Workflow')
     parser.add_argument('--new_trace', dest='new_trace', help='whether the target should be traced again', action='store_true')
     parser.add_argument('--keep_log', dest='keep_log', help='whether trace logs should be preserved', action='store_true')
+    parser.add_argument('--environment', dest='environment_dir', type=str, help='path to, or for, a directory of environment snapshots', default='.environment')
+    parser.add_argument('--new_env', dest='new_env', help='whether the environment snapshot should be captured again', action='store_true')
+    parser.add_argument('--trace_cache', dest='trace_cache', type=str, help='path to, or for, a directory of cached trace results', default='.trace_cache')
+    parser.add_argument('--cache_size', dest='cache_size', type=int, help='maximum number of cached trace results', default=256)
+    parser.add_argument('--no_cache', dest='no_cache', help='whether cached trace results should be ignored (reusing existing trace logs instead)', action='store_true')
+    parser.add_argument('--stream', dest='stream', help='whether traces should be analyzed while the target runs instead of being written to trace logs', action='store_true')
+    parser.add_argument('--archive', dest='archive', help='whether preserved trace logs should be stored as compact trace archives', action='store_true')
+    parser.add_argument('--backend', dest='backend', type=str, choices=['strace', 'seccomp', 'audit'], help='how targets are traced (seccomp filters system calls in the kernel, audit only traces python processes)', default='strace')
+    parser.add_argument('--jobs', dest='jobs', type=int, help='number of targets to trace and parse concurrently', default=1)
+    parser.add_argument('--shards', dest='shards', type=int, help='number of parallel jobs that the scripts of each target are split across, balanced by timed traces', default=1)
+    parser.add_argument('--dependency_cache', dest='dependency_cache', help='whether generated jobs should cache the pip cache and virtualenv with actions/cache', action='store_true')
+    parser.add_argument('--setup_job', dest='setup_job', help='whether generated jobs should share a virtualenv built once by a setup job', action='store_true')
+    parser.add_argument('--merge_jobs', dest='merge_jobs', type=str, choices=['none', 'matrix', 'steps'], help='how jobs that only differ in their scripts are merged', default='none')
+    parser.add_argument('--profile', dest='profile', type=str, nargs='?', const='profile.json', help='path for a report of the time, memory and subprocesses of each phase', default=None)
+    parser.add_argument('--cprofile', dest='cprofile', type=str, help='path for a cProfile dump of the run', default=None)
     return parser.parse_args()
 
 
+# Give each target its own log file when several targets are traced (e.g. trace.log -> trace_3.log)
+def isolate_log(path, index, count):
+    if count <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}_{index}{ext}'
+
+
+# Environment shared by every target that a worker process traces (set once per worker instead of being sent with each target)
+WORKER_ENVIRONMENT = None
+
+
+# Prepare a worker process to trace targets
+def init_worker(environment, profile=False):
+    global WORKER_ENVIRONMENT
+    WORKER_ENVIRONMENT = environment
+    if profile:
+        profiling.enable()
+
+
+# Trace and parse a single target in a worker process
+# - Only the parsed fields are returned (without the environment), along with the phases profiled by the worker
+def trace_target(options):
+    tracing = Tracing(**options, environment=WORKER_ENVIRONMENT)
+    tracing.release()
+    return tracing, profiling.collect()
+
+
 def main():
     args = parse_args()
+    if args.profile is not None:
+        profiling.enable()
+    if args.cprofile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    run(args)
+    if args.cprofile is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+    if args.profile is not None:
+        profiling.write_report(args.profile, profiling.collect())
+
+
+def run(args):
     targets = [f'{args.target}/{path}' for path in os.listdir(args.target) if os.path.isfile(os.path.abspath(f'{args.target}/{path}'))] if os.path.isdir(args.target) else [args.target]
     targets.reverse()
-    tracings = []
-    for i, target in enumerate(targets):
-        tracings.append(Tracing(target=target,
-                        new_trace=args.new_trace,
-                        host_container=args.host_container,
-                        trace_log=args.trace_log,
-                        paths_log=args.paths_log,
-                        docker_log=args.docker_log,
-                        requirements_log=args.requirements_log))
-        if args.keep_log:
-            os.renames(args.trace_log, f'logs/{i}_{os.path.basename(target).replace(".sh", ".log")}')
-    ciyaml = YamlCI(tracings)
+    with profiling.phase('environment'):
+        environment = Environment.load(args.host_container, args.docker_log, args.environment_dir, args.new_env)
+    cache = TraceCache(args.trace_cache, args.cache_size) if not args.no_cache else None
+    options = [{'target': target,
+                'new_trace': args.new_trace,
+                'host_container': args.host_container,
+                'trace_log': isolate_log(args.trace_log if args.trace_log is not None else 'trace.log', i, len(targets)),
+                'paths_log': isolate_log(args.paths_log, i, len(targets)),
+                'docker_log': args.docker_log,
+                'requirements_log': args.requirements_log,
+                'cache': cache,
+                'stream': args.stream,
+                'timing': args.shards > 1,
+                'backend': args.backend,
+                'reuse_log': args.trace_log is not None} for i, target in enumerate(targets)]
+    if args.jobs > 1 and len(targets) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(environment, args.profile is not None)) as executor:
+            results = list(executor.map(trace_target, options)) # Results are returned in target order
+        tracings = [tracing for tracing, _ in results]
+        for tracing, records in results:
+            tracing.environment = environment
+            profiling.merge(records)
+    else:
+        tracings = [Tracing(**option, environment=environment) for option in options]
+    if args.keep_log:
+        for i, (target, option) in enumerate(zip(targets, options)):
+            if not os.path.exists(option['trace_log']): # Targets with cached trace results, or streamed traces, have no trace log
+                continue
+            if is_archive(option['trace_log']): # Traces that were given as archives are kept as they are
+                os.renames(option['trace_log'], f'logs/{i}_{os.path.basename(target).replace(".sh", ".mlta")}')
+                continue
+            if args.archive: # Keep a compact archive of the trace instead of the trace log
+                os.makedirs('logs', exist_ok=True)
+                text_to_archive(option['trace_log'], f'logs/{i}_{os.path.basename(target).replace(".sh", ".mlta")}')
+                os.remove(option['trace_log'])
+                continue
+            os.renames(option['trace_log'], f'logs/{i}_{os.path.basename(target).replace(".sh", ".log")}')
+    ciyaml = YamlCI(tracings, shards=args.shards, dependency_cache=args.dependency_cache, setup_job=args.setup_job, merge=args.merge_jobs)
     ciyaml.dump(args.workflow)
 
 
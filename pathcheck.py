@@ -0,0 +1,34 @@
+import agent
+
+# Filter the paths that exist, listing each parent directory once instead of checking each path
+# - Imports are local so that the source of this function can also be run within a host container
+def filter_existing_paths(paths):
+    import os
+    directories = {}
+    for path in paths:
+        directory, name = os.path.split(path)
+        directories.setdefault(directory, []).append((name, path))
+
+    existing = []
+    for directory, names in directories.items():
+        try:
+            with os.scandir(directory or '.') as entries:
+                listing = {entry.name: entry for entry in entries}
+        except (FileNotFoundError, NotADirectoryError, ValueError):
+            continue # None of the directory's paths exist
+        except OSError:
+            listing = None # Directories that cannot be listed may still allow their paths to be accessed
+        for name, path in names:
+            entry = listing.get(name) if listing is not None else None
+            if listing is None or name in ('', '.', '..') or entry is not None and entry.is_symlink():
+                if os.path.exists(path): # Fall back to resolving the path itself (e.g. roots, dot components and symlinks)
+                    existing.append(path)
+            elif entry is not None:
+                existing.append(path)
+    return existing
+
+# Retrieve the paths that exist on the system (or within the host container, using a single request to its helper agent)
+def find_existing_paths(paths, host_container=None):
+    if host_container is None:
+        return filter_existing_paths(paths)
+    return agent.connect(host_container).request('existing_paths', paths=list(paths))
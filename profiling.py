@@ -0,0 +1,105 @@
+import contextlib
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+
+# Profiler of the current process (None when profiling is disabled)
+PROFILER = None
+
+# Class that records the wall time, CPU time, peak memory and subprocesses of each phase of a run
+class Profiler:
+    def __init__(self):
+        self.records = []
+        self.stack = [] # Phases that are currently running (innermost last)
+
+    # Record a phase (phases may be nested, e.g. the phases of a target within its tracing)
+    @contextlib.contextmanager
+    def phase(self, name, target=None):
+        record = {'phase': name, 'target': target, 'pid': os.getpid(), 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_memory': 0, 'subprocesses': []}
+        self.enter(record)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.perf_counter() - wall_start
+            record['cpu_time'] = time.process_time() - cpu_start
+            self.exit(record)
+
+    # Start measuring the peak memory of a phase (the peak so far is kept by the enclosing phase)
+    def enter(self, record):
+        if len(self.stack) != 0:
+            self.stack[-1]['peak_memory'] = max(self.stack[-1]['peak_memory'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self.stack.append(record)
+
+    # Stop measuring the peak memory of a phase (and include it in the enclosing phase)
+    def exit(self, record):
+        self.stack.pop()
+        record['peak_memory'] = max(record['peak_memory'], tracemalloc.get_traced_memory()[1])
+        if len(self.stack) != 0:
+            self.stack[-1]['peak_memory'] = max(self.stack[-1]['peak_memory'], record['peak_memory'])
+        tracemalloc.reset_peak()
+        self.records.append(record)
+
+    # Record a subprocess within the current phase
+    def add_subprocess(self, record):
+        if len(self.stack) != 0:
+            self.stack[-1]['subprocesses'].append(record)
+
+# Popen that records the command and duration of each subprocess while profiling
+class ProfiledPopen(subprocess.Popen):
+    def __init__(self, args, *popen_args, **popen_kwargs):
+        command = args if isinstance(args, str) else ' '.join(str(arg) for arg in args)
+        self.profile_record = {'command': command[:200], 'duration': None}
+        self.profile_start = time.perf_counter()
+        super().__init__(args, *popen_args, **popen_kwargs)
+        if PROFILER is not None:
+            PROFILER.add_subprocess(self.profile_record)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if self.profile_record['duration'] is None:
+            self.profile_record['duration'] = time.perf_counter() - self.profile_start
+        return returncode
+
+# Enable profiling for the current process (worker processes start with a profiler of their own)
+def enable():
+    global PROFILER
+    PROFILER = Profiler()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    subprocess.Popen = ProfiledPopen # subprocess.run also creates its subprocesses with subprocess.Popen
+
+# Record a phase (or do nothing when profiling is disabled)
+def phase(name, target=None):
+    if PROFILER is None:
+        return contextlib.nullcontext()
+    return PROFILER.phase(name, target)
+
+# Retrieve, and clear, the phases recorded by the current process (e.g. to return them from a worker process)
+def collect():
+    if PROFILER is None:
+        return []
+    records, PROFILER.records = PROFILER.records, []
+    return records
+
+# Include the phases recorded by another process (e.g. a worker process)
+def merge(records):
+    if PROFILER is not None:
+        PROFILER.records.extend(records)
+
+# Write a report of the recorded phases, with totals for each phase
+def write_report(path, records):
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['phase'], {'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_memory': 0, 'subprocess_count': 0, 'subprocess_time': 0.0})
+        total['count'] += 1
+        total['wall_time'] += record['wall_time']
+        total['cpu_time'] += record['cpu_time']
+        total['peak_memory'] = max(total['peak_memory'], record['peak_memory'])
+        total['subprocess_count'] += len(record['subprocesses'])
+        total['subprocess_time'] += sum(subprocess_record['duration'] or 0.0 for subprocess_record in record['subprocesses'])
+    with open(path, 'w') as report:
+        json.dump({'totals': totals, 'phases': records}, report, indent=4)
@@ -0,0 +1,80 @@
+import os
+import re
+
+# Read the python package paths
+# - Imports are local so that the source of this function can also be run within a host container
+def read_module_paths():
+    import site
+    import sys
+    return [path for path in sys.path + [site.USER_BASE] + [site.USER_SITE] if path and path.strip() != '']
+
+# Read the modification times of the python package paths (changed when modules are installed or removed, or None if missing)
+def read_module_path_mtimes():
+    import os
+    return {path: os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in read_module_paths()}
+
+# Read the files of every distribution installed in the python package paths
+def read_distribution_records(module_paths):
+    import importlib.metadata
+    import os
+    records = []
+    for distribution in importlib.metadata.distributions(path=module_paths):
+        name = distribution.metadata['Name']
+        if name is None:
+            continue
+        root = os.path.normpath(str(distribution.locate_file('')))
+        top_level = (distribution.read_text('top_level.txt') or '').split()
+        files = [str(file) for file in distribution.files or []]
+        records.append({'name': name, 'version': distribution.version, 'root': root, 'top_level': top_level, 'files': files})
+    return records
+
+# Retrieve the python package paths and distribution records of the system (host containers are read through their helper agent)
+def load_python_packages():
+    module_paths = read_module_paths()
+    return {'module_paths': module_paths, 'distributions': read_distribution_records(module_paths)}
+
+# Normalize a distribution name so that names from pip and from package metadata can be compared (PEP 503)
+def canonicalize_name(name):
+    return re.sub('[-_.]+', '-', name).lower()
+
+# Class that maps paths to the installed distributions that own them
+class DistributionIndex:
+    def __init__(self, records):
+        self.files = {} # Installed file -> distribution name
+        self.directories = {} # Package directory -> distribution name (None if shared, e.g. by namespace packages)
+        for record in records:
+            name = record['name']
+            root = record['root']
+            for file in record['files']:
+                component = file.split('/', 1)[0]
+                if component == '..' or component.endswith('.dist-info') or component.endswith('.egg-info'):
+                    continue # Metadata is read for every distribution at runtime, and scripts live outside the package paths
+                path = os.path.normpath(os.path.join(root, file))
+                self.files[path] = name
+                self.index_directories(os.path.dirname(path), root, name)
+            for module in record['top_level']: # Covers files that are not recorded (e.g. compiled bytecode)
+                self.index_directories(os.path.join(root, module.replace('.', '/')), root, name)
+
+    # Index every directory between a path and its package root
+    def index_directories(self, directory, root, name):
+        while directory != root and len(directory) > len(root):
+            owner = self.directories.setdefault(directory, name)
+            if owner == name:
+                directory = os.path.dirname(directory)
+                continue
+            self.directories[directory] = None
+            break
+
+    # Retrieve the name of the distribution that owns a path (or None if no distribution owns the path)
+    def lookup(self, path):
+        path = os.path.normpath(path)
+        if path in self.files:
+            return self.files[path]
+        directory = path
+        while True:
+            if directory in self.directories:
+                return self.directories[directory]
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return None
+            directory = parent
@@ -0,0 +1,37 @@
+import pytest
+from agent import HelperAgent
+
+# Start a local stand-in for a host container's helper agent (the same protocol, without docker)
+@pytest.fixture
+def helper():
+    helper = HelperAgent.local()
+    yield helper
+    helper.close()
+
+# Pipelined requests are answered in order, and results can be waited on in any order
+def test_pipelined_requests(helper, tmp_path):
+    existing = tmp_path / 'existing.txt'
+    existing.write_text('content')
+    requests = [helper.submit('existing_paths', paths=[str(existing), str(tmp_path / 'missing.txt')]),
+                helper.submit('read_file', path=str(existing)),
+                helper.submit('read_file', path=str(tmp_path / 'missing.txt')),
+                helper.submit('pip_freeze')]
+    assert requests == sorted(requests)
+    assert isinstance(helper.result(requests[3]), str) # Earlier responses are buffered until they are waited on
+    assert helper.result(requests[0]) == [str(existing)]
+    assert helper.result(requests[1]) == 'content'
+    assert helper.result(requests[2]) is None
+
+# Failed requests raise their error without disrupting later requests
+def test_error_unwrapping(helper, tmp_path):
+    failed = helper.submit('unknown_op')
+    succeeded = helper.submit('read_file', path=str(tmp_path / 'missing.txt'))
+    with pytest.raises(RuntimeError, match='KeyError'):
+        helper.result(failed)
+    assert helper.result(succeeded) is None
+
+# Streamed results pass each line to on_line before the result arrives
+def test_streamed_trace(helper):
+    lines = []
+    assert helper.request('trace', on_line=lines.append, command='cat', script='first\nsecond\n') == 0
+    assert lines == ['first\n', 'second\n']
@@ -0,0 +1,38 @@
+from tracing import TraceAnalysis, Tracing
+
+# Build a timed trace of a shell (pid 100) that runs each command, in order, for the given durations
+def timed_trace(commands):
+    calls, time = [], 1000.0
+    for pid, (argv, duration) in enumerate(commands, start=101):
+        arguments = ', '.join(f'"{argument}"' for argument in argv)
+        calls.append(f'100 {time:.6f} clone(child_stack=NULL, flags=CLONE_CHILD_SETTID|SIGCHLD) = {pid}\n')
+        calls.append(f'{pid} {time + 0.01:.6f} execve("/usr/bin/{argv[0]}", [{arguments}], 0x7ffd /* 20 vars */) = 0\n')
+        time += duration
+        calls.append(f'100 {time:.6f} wait4(-1, [{{WIFEXITED(s) && WEXITSTATUS(s) == 0}}], 0, NULL) = {pid}\n')
+    return calls
+
+# Parse the timings of a target's scripts from a timed trace of their commands
+def parse_timings(tmp_path, scripts, commands):
+    target = tmp_path / 'target.sh'
+    target.write_text('\n'.join(scripts) + '\n')
+    tracing = Tracing.__new__(Tracing)
+    tracing.target = str(target)
+    tracing.analysis = TraceAnalysis()
+    for call in timed_trace(commands):
+        tracing.analysis.feed(call)
+    return [round(timing, 3) for timing in tracing.parse_timings()]
+
+# Commands of the same interpreter are attributed to the script that names their arguments
+def test_repeated_interpreter(tmp_path):
+    timings = parse_timings(tmp_path, ['cd x', 'python3 a.py', 'python3 b.py'], [(['python3', 'a.py'], 1.0), (['python3', 'b.py'], 1.2)])
+    assert timings == [0.0, 1.0, 1.2]
+
+# Scripts that are repeated as is are each attributed their own command
+def test_repeated_script(tmp_path):
+    timings = parse_timings(tmp_path, ['python3 -m pytest tests', 'python3 -m pytest tests'], [(['python3', '-m', 'pytest', 'tests'], 2.0), (['python3', '-m', 'pytest', 'tests'], 3.0)])
+    assert timings == [2.0, 3.0]
+
+# Commands that no script names are attributed to the last matched script
+def test_unnamed_command(tmp_path):
+    timings = parse_timings(tmp_path, ['python3 /src/a.py | tee out.log', 'python3 b.py'], [(['python3', '/src/a.py'], 1.0), (['tee', 'out.log'], 0.5), (['env'], 0.25), (['python3', 'b.py'], 2.0)])
+    assert timings == [1.75, 2.0]
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+
+# Class that caches parsed trace results, keyed by the content of the target and the environment it is traced in
+class TraceCache:
+    def __init__(self, directory='.trace_cache', max_entries=256):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    # Retrieve the key of a target's trace results
+    # - The target's location is included because the target wrapper navigates to its own directory
+    # - Backends other than strace trace different calls, so their results are cached separately
+    # - Results analyzed from an existing trace log (rather than a new trace) are also keyed by the content of that log
+    def get_key(self, target, fingerprint, backend='strace', trace_log=None):
+        key = hashlib.sha256()
+        key.update(f'{os.path.abspath(target)}\n{fingerprint}\n'.encode())
+        if backend != 'strace':
+            key.update(f'backend:{backend}\n'.encode())
+        with open(target, 'rb') as file:
+            key.update(file.read())
+        if trace_log is not None:
+            key.update(b'\ntrace_log:\n')
+            with open(trace_log, 'rb') as log:
+                for chunk in iter(lambda: log.read(1 << 20), b''):
+                    key.update(chunk)
+        return key.hexdigest()
+
+    # Retrieve cached trace results (or None if they have not been cached)
+    def get(self, key):
+        path = f'{self.directory}/{key}.json'
+        try:
+            with open(path, 'r') as file:
+                summary = json.load(file)
+        except (OSError, ValueError):
+            return None
+        os.utime(path) # Mark the entry as recently used
+        return summary
+
+    # Cache trace results and evict the least recently used entries beyond the cache size
+    def put(self, key, summary):
+        os.makedirs(self.directory, exist_ok=True)
+        path = f'{self.directory}/{key}.json'
+        with open(f'{path}.{os.getpid()}.tmp', 'w') as file:
+            json.dump(summary, file)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+        self.evict()
+
+    # Remove the least recently used entries until the cache fits its size
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    entries.append((entry.stat().st_mtime_ns, entry.path))
+                except OSError:
+                    continue # Evicted concurrently by another process
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.max_entries, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
@@ -1,8 +1,109 @@
-import sys
 import os
-import site
 import subprocess
 import re
+import agent
+import profiling
+from backends import get_backend
+from environment import Environment, parse_modules
+from pathcheck import find_existing_paths
+from resolver import canonicalize_name
+
+# Patterns used to extract information from individual system calls
+QUOTED_PATTERN = re.compile('\"(.+?)\"')
+DECODED_PATTERN = re.compile('<(.+?)>')
+PORT_PATTERN = re.compile('(?<=sin_port=htons\\()\\d*')
+VERSION_PATTERN = re.compile('(?<=[\\/]python)(.+?)(?=[\\/])')
+RELEASE_PATTERN = re.compile('^\\d\\..*')
+
+# Patterns used to extract the processes of a timed system trace (see backends.py)
+PROCESS_PATTERN = re.compile('^(\\d+)\\s+(\\d+\\.\\d+)\\s+(?:<\\.\\.\\.\\s+)?(clone3?|v?fork|execve|wait4)\\b')
+RESULT_PATTERN = re.compile('=\\s+(\\d+)\\s*$')
+ARGV_PATTERN = re.compile('^[^\\[]*\\[(.*?)\\]')
+
+# Leading bytes of compact trace archives (see archive.py)
+ARCHIVE_MAGIC = b'MLTA'
+
+# Check whether a trace log is a compact trace archive
+def is_archive(trace_log):
+    with open(trace_log, 'rb') as log:
+        return log.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+# Parse the language runtime versions referenced by a path (general or non-sense versions are removed)
+def parse_path_versions(path):
+    return [version for version in VERSION_PATTERN.findall(path) if RELEASE_PATTERN.match(version)]
+
+# Count the arguments of a command that a script names (or -1 if the script does not name the command's executable)
+# - Options are skipped, and paths are matched by their base name (e.g. python3 /src/test.py -> python3 test.py)
+def count_named_arguments(script, argv):
+    def names(name):
+        return re.search(f'(?<![\\w.-]){re.escape(os.path.basename(name))}(?![\\w.-])', script) is not None
+    if not names(argv[0]):
+        return -1
+    return len([argument for argument in argv[1:] if not argument.startswith('-') and os.path.basename(argument) != '' and names(argument)])
+
+# Class that extracts paths, ports, versions and (for timed traces) commands from a system trace in a single pass
+class TraceAnalysis:
+    def __init__(self):
+        self.candidates = set() # Distinct strings that may be paths
+        self.ports = set()
+        self.versions = {} # Candidates that reference a language runtime version, mapped to those versions
+        self.root_pid = None # Process of the target's shell
+        self.commands = {} # Processes forked by the target's shell, mapped to their start time, end time and arguments
+        self.last_time = None
+
+    # Load a trace log line by line (without keeping the lines in memory), or load a trace archive
+    @classmethod
+    def from_log(cls, trace_log):
+        if is_archive(trace_log):
+            from archive import TraceArchive
+            with TraceArchive.open(trace_log) as archive:
+                return archive.get_analysis()
+        analysis = cls()
+        with open(trace_log, 'r') as log:
+            for call in log:
+                analysis.feed(call)
+        return analysis
+
+    # Accumulate the paths, ports and versions referenced by a single system call
+    def feed(self, call):
+        for path in QUOTED_PATTERN.findall(call) + DECODED_PATTERN.findall(call):
+            self.add_candidate(path)
+        if 'sin_port' in call:
+            self.ports.update(port for port in PORT_PATTERN.findall(call) if port != '')
+        process = PROCESS_PATTERN.match(call)
+        if process is not None:
+            self.feed_process(call, int(process.group(1)), float(process.group(2)), process.group(3))
+
+    # Accumulate the start, end and arguments of the commands run by the target's shell
+    # - Commands start when the shell forks them, are named by their first execve and end when the shell reaps them
+    def feed_process(self, call, pid, time, syscall):
+        if self.root_pid is None:
+            self.root_pid = pid
+        self.last_time = time
+        if syscall == 'execve':
+            if pid in self.commands and self.commands[pid][2] is None:
+                argv = ARGV_PATTERN.match(call[call.index('execve'):])
+                self.commands[pid][2] = QUOTED_PATTERN.findall(argv.group(1)) if argv is not None else []
+            return
+        result = RESULT_PATTERN.search(call)
+        if pid != self.root_pid or result is None:
+            return
+        child = int(result.group(1))
+        if syscall == 'wait4':
+            if child in self.commands:
+                self.commands[child][1] = time
+        else:
+            self.commands[child] = [time, None, None]
+
+    # Accumulate a string that may be a path (and the versions that it references)
+    def add_candidate(self, path):
+        if path in self.candidates:
+            return
+        self.candidates.add(path)
+        if 'python' in path:
+            versions = parse_path_versions(path)
+            if len(versions) != 0:
+                self.versions[path] = versions
 
 # Class that initiates and parses system traces of a program
 class Tracing:
@@ -13,62 +114,127 @@ class Tracing:
                  trace_log = 'trace.log',
                  paths_log = 'paths.log',
                  docker_log = 'docker.log',
-                 requirements_log = 'requirements.txt'):
-        # Load the trace logs (or create it if it do not exist)
+                 requirements_log = 'requirements.txt',
+                 environment = None,
+                 cache = None,
+                 stream = False,
+                 timing = False,
+                 backend = 'strace',
+                 reuse_log = False):
+        # Capture the environment that the target runs in (unless a shared snapshot is provided)
+        with profiling.phase('environment', target):
+            self.environment = environment if environment is not None else Environment.capture(host_container, docker_log)
+
+        # Load cached trace results (targets that are not cached, or have changed, are traced again)
+        # - Trace logs given by the user (or trace archives) are analyzed rather than overwritten, and cached by their content
         self.target = target
-        if new_trace or not os.path.exists(trace_log):
-            self.log_trace(target, host_container)
-        with open(trace_log, 'r') as log:
-            self.trace = list(log.read().splitlines())
+        self.backend = get_backend(backend, timing)
+        summary = None
+        if cache is not None:
+            with profiling.phase('cache', target):
+                reuse_log = not new_trace and os.path.exists(trace_log) and (reuse_log or is_archive(trace_log))
+                cache_key = cache.get_key(target, self.environment.fingerprint, backend, trace_log if reuse_log else None)
+                summary = None if new_trace else cache.get(cache_key)
+                if self.backend.timing and not reuse_log and summary is not None and summary.get('timings') is None: # Cached without timing
+                    summary = None
+            new_trace = summary is None and not reuse_log
+
+        if summary is None:
+            # Analyze the trace logs in a single pass (or create it if it do not exist)
+            new_trace = new_trace or not os.path.exists(trace_log)
+            if stream and new_trace:
+                with profiling.phase('trace', target):
+                    self.analysis = self.stream_trace(target, host_container)
+            else:
+                if new_trace:
+                    with profiling.phase('trace', target):
+                        self.log_trace(target, host_container, trace_log)
+                with profiling.phase('analysis', target):
+                    self.analysis = TraceAnalysis.from_log(trace_log)
 
-        # Load the paths logs (or create it if it do not exist)
-        if new_trace or not os.path.exists(paths_log):
-            self.log_paths(host_container)
-        with open(paths_log, 'r') as log:
-            self.paths = log.read().splitlines()
+            # Load the paths logs (or create it if it do not exist, or the trace was analyzed on a cache miss)
+            with profiling.phase('paths', target):
+                if new_trace or cache is not None or not os.path.exists(paths_log):
+                    self.log_paths(host_container, paths_log)
+                with open(paths_log, 'r') as log:
+                    self.paths = log.read().splitlines()
 
-        # Parse scripts from system trace
+            # Generate a trace summary for missing/unresolvable features from the trace logs
+            if new_trace and os.path.exists(trace_log):
+                self.log_summary()
+
+            # Parse runtime information from system trace
+            with profiling.phase('runtime', target):
+                summary = {'paths': self.paths,
+                           'versions': sorted(self.parse_versions()),
+                           'ports': sorted(self.parse_ports()),
+                           'candidates': sorted(self.parse_candidates()),
+                           'timings': self.parse_timings()}
+            if cache is not None:
+                with profiling.phase('cache', target):
+                    cache.put(cache_key, summary)
+        self.paths = summary['paths']
+        self.versions = summary['versions']
+        self.ports = summary['ports']
+
+        # Parse scripts from system trace (and how long each of them ran, if the trace was timed)
         self.scripts = self.parse_scripts()
+        self.timings = summary.get('timings')
+
+        # Parse requirements that are not user-specified
+        with profiling.phase('requirements', target):
+            requirements = self.read_requirements_log(requirements_log, host_container)
+            self.requirements_log = requirements_log if requirements is not None else None
+            self.requirements = self.parse_requirements(requirements, summary['candidates'])
 
-        # Generate a trace summary for missing/unresolvable features from the trace logs
-        if new_trace and os.path.exists(trace_log):
-            self.log_summary()
-        
-        # Parse runtime information from system trace
-        self.versions = self.parse_versions()
-        self.requirements_log = requirements_log if os.path.exists(requirements_log) else None
-        self.requirements = self.parse_requirements(requirements_log, host_container)
-        self.ports = self.parse_ports()
-        
         # Parse containers from system trace
-        self.docker = self.parse_docker(docker_log)
-        self.job_container = self.parse_job_container()
-        self.service_containers = self.parse_service_containers()
+        with profiling.phase('containers', target):
+            self.docker = self.parse_docker()
+            self.job_container = self.parse_job_container()
+            self.service_containers = self.parse_service_containers()
+
+    # Drop the environment and trace analysis, which are only needed while parsing (e.g. before returning the tracing from a worker process)
+    def release(self):
+        self.environment = None
+        self.analysis = None
 
     #========================================================================================================
     #                                        GENERATE TRACE-RELATED LOGS
     #========================================================================================================
 
     # Trace the target and write the trace log to a file
-    def log_trace(self, target, host_container=None):
-        command = f'strace --follow-forks --decode-fds=path --trace=%file,%network --string-limit=999 --quiet=all --successful-only --output=trace.log bash {target}'
-        if host_container is not None:
-            command = command.replace(f'bash {target}', f'bash -s')
-            command = f'cat {target} | docker exec -i {host_container} {command}; docker exec -it {host_container} cat trace.log > trace.log; docker exec -it {host_container} rm trace.log'
+    def log_trace(self, target, host_container=None, trace_log='trace.log'):
+        if host_container is not None: # The container's helper agent streams the trace back to be written locally
+            with open(trace_log, 'w', errors='surrogateescape') as log:
+                self.trace_container(target, host_container, log.write)
+            return
+        command = self.backend.get_command(trace_log, target)
         subprocess.run(command, shell=True)
 
+    # Trace the target and analyze its system calls while it runs (without writing a trace log)
+    # - The backend writes to a duplicate of the pipe that is read here, and the target's own output is discarded
+    def stream_trace(self, target, host_container=None):
+        analysis = TraceAnalysis()
+        if host_container is not None:
+            self.trace_container(target, host_container, analysis.feed)
+            return analysis
+        command = f'{self.backend.get_command("/dev/fd/3", target)} 3>&1 >/dev/null 2>&1'
+        with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, text=True, errors='surrogateescape') as process:
+            for call in process.stdout:
+                analysis.feed(call)
+        return analysis
+
+    # Trace the target within the host container, passing each traced system call to on_call as it arrives
+    def trace_container(self, target, host_container, on_call):
+        with open(target, 'r', errors='surrogateescape') as file:
+            script = file.read()
+        command = f'{self.backend.get_command("/dev/fd/3")} 3>&1 >/dev/null 2>&1'
+        agent.connect(host_container).request('trace', on_line=on_call, command=command, script=script)
+
     # Parse distinct paths from system trace and write them to a file
-    def log_paths(self, host_container=None):          
-        paths = []
-        for call in self.trace:
-            paths.extend(re.findall('\"(.+?)\"', call))
-            paths.extend(re.findall('<(.+?)>', call))
-        # For host container, assumes that all paths exist (due to successful-only file-based strace) and non-paths don't start with '/'
-        # Potential, but more complex, alternative is to check if the files exists within the container itself and return the result
-        paths = list(set([path for path in paths
-                          if host_container is None and os.path.exists(path)
-                          or host_container is not None and path[0] == '/']))
-        with open('paths.log', 'w') as log:
+    def log_paths(self, host_container=None, paths_log='paths.log'):
+        paths = find_existing_paths(self.analysis.candidates, host_container)
+        with open(paths_log, 'w') as log:
             log.writelines("\n".join(paths))
         
     # Generate a trace summary for missing/unresolvable features from the trace logs
@@ -81,69 +247,44 @@ class Tracing:
 
     # Parse language runtime versions
     def parse_versions(self):
-        versions = []
-        path_versions = [re.findall('(?<=[\\/]python)(.+?)(?=[\\/])', path) for path in self.paths] # Find all versions in python invocations in paths
-        for path_version in path_versions: # Flatten versions to a single dimensional list
-            versions.extend(path_version)
-        versions = list(set(versions)) # Remove non-unique versions from the single dimensional list
-        versions = [version for version in versions if len(re.findall('^\\d\\..*', version)) != 0] # Remove general or non-sense versions from the single dimensional list
-        return versions
+        versions = set()
+        for path in self.paths:
+            path_versions = self.analysis.versions.get(path) # Reuse versions found while analyzing the trace
+            if path_versions is None and path not in self.analysis.candidates: # Paths logged by an earlier trace still need to be parsed
+                path_versions = parse_path_versions(path)
+            versions.update(path_versions or [])
+        return list(versions)
 
-    # Parse requirements, or pip modules, that are not user-specified
-    def parse_requirements(self, requirements_log, host_container=None):
-        # Parse module candidates found in the python package paths
-        module_paths = sys.path + [site.USER_BASE] + [site.USER_SITE]
-        if host_container is not None:
-            command = f'docker exec -it {host_container} python3 -c "import sys,site; print(sys.path + [site.USER_BASE] + [site.USER_SITE])"'
-            result = subprocess.run(command, shell=True, capture_output=True, text=True)
-            module_paths = eval(result.stdout)
-        module_paths = [path for path in module_paths if path.strip() != '']
+    # Parse module candidates from the distributions that own the traced paths
+    def parse_candidates(self):
+        index = self.environment.get_index()
+        return set(canonicalize_name(module) for module in map(index.lookup, self.paths) if module is not None)
 
-        modules_candidates = []
-        for path in self.paths:
-            for module_path in module_paths:
-                if module_path in path:
-                    new_path = path.replace(module_path, '').replace('/','.')
-                    new_path = new_path[1:] if len(new_path) > 0 and new_path[0] == '.' else new_path
-                    if new_path != '':
-                        modules_candidates.append(new_path)
-                        break
-        modules_candidates = list(set(modules_candidates))
+    # Parse requirements, or pip modules, that are not user-specified
+    def parse_requirements(self, requirements, modules_candidates=None):
+        # Use the module candidates parsed alongside the trace (or parse them now)
+        modules_candidates = set(modules_candidates if modules_candidates is not None else self.parse_candidates())
 
         # Retrieve all modules that are installed on the system
-        command = f'pip freeze'
-        if host_container is not None:
-            command = f'docker exec -i {host_container} {command}'
-        subprocess.run(command, shell=True, capture_output=True, text=True)
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        modules_installed = {}
-        for module in result.stdout.splitlines():
-            module_parsed = {module: ''}
-            if any(delim in module for delim in ['<','>','=']):
-                module_split = re.split('[<>=]', module, 1)
-                module_parsed = {module_split[0].strip(): module_split[1].strip()[1:]}
-            modules_installed.update(module_parsed)
-                
+        modules_installed = self.environment.installed
+
         # Retrieve all the user-specified modules in the requirements log
-        modules_logged = {}
-        if host_container is not None:
-            command = f'docker exec -it {host_container} cat {requirements_log} > requirements.txt'
-            subprocess.run(command, shell=True)
-        if os.path.exists(requirements_log):
-            with open(requirements_log, 'r') as log:
-                modules_nonempty = [module for module in log.readlines() if module.strip() != '']
-            modules_logged = {}
-            for module in modules_nonempty:
-                module_parsed = {module: ''}
-                if any(delim in module for delim in ['<','>','=']):
-                    module_split = re.split('[<>=]', module, 1)
-                    module_parsed = {module_split[0].strip(): module_split[1].strip()[1:]}
-                modules_logged.update(module_parsed)
+        modules_logged = parse_modules(requirements.splitlines()) if requirements is not None else {}
 
         # Remove module candidates that are not install on the system or have already been specified by the user
-        modules_parsed = {module: version for module, version in modules_installed.items() if module in modules_candidates and module not in modules_logged}
+        modules_logged = set(canonicalize_name(module.strip()) for module in modules_logged)
+        modules_parsed = {module: version for module, version in modules_installed.items() if canonicalize_name(module) in modules_candidates and canonicalize_name(module) not in modules_logged}
         return modules_parsed
 
+    # Read the requirements log of the system (or of the host container, or None if it does not exist)
+    def read_requirements_log(self, requirements_log, host_container=None):
+        if host_container is not None:
+            return agent.connect(host_container).request('read_file', path=requirements_log)
+        if not os.path.exists(requirements_log):
+            return None
+        with open(requirements_log, 'r') as log:
+            return log.read()
+
     # Parse configuration of a script used in target
     def parse_scripts(self):
         # Because system call logs do not properly reproduce the pipes, redirects, etc. in the target, log parsing isn't used here
@@ -151,36 +292,41 @@ class Tracing:
             scripts = [script.strip() for script in file.readlines()]
         return scripts
     
+    # Parse how long each script ran from the commands of a timed trace (or None if the trace was not timed)
+    # - Commands are matched, in order, to the remaining script that names most of their arguments (e.g. python3 b.py -> python3 b.py, not python3 a.py)
+    # - Scripts that are repeated as is are matched once each, and commands that no script names (e.g. subshells) are attributed to the last matched script
+    def parse_timings(self):
+        if len(self.analysis.commands) == 0:
+            return None
+        scripts = self.parse_scripts()
+        spans = [None] * len(scripts)
+        matched = [None] * len(scripts) # Arguments of the command that each script was matched to
+        current = 0
+        for start, end, argv in sorted(self.analysis.commands.values(), key=lambda command: command[0]):
+            if argv is not None and len(argv) != 0:
+                counts = [count_named_arguments(scripts[i], argv) for i in range(current, len(scripts))]
+                if len(counts) != 0 and max(counts) >= 0:
+                    candidates = [current + i for i, count in enumerate(counts) if count == max(counts)]
+                    current = next((i for i in candidates if matched[i] != argv), candidates[0])
+                    matched[current] = argv
+            if current >= len(scripts):
+                break
+            end = end if end is not None else self.analysis.last_time # Commands that were not reaped ran until the trace ended
+            spans[current] = [start, end] if spans[current] is None else [min(spans[current][0], start), max(spans[current][1], end)]
+        return [span[1] - span[0] if span is not None else 0.0 for span in spans]
+
     # Parse port information
     def parse_ports(self):
-        ports = [''.join(re.findall("(?<=sin_port=htons\\()\\d*", trace)) for trace in self.trace] # Attempt to find all references to ports in traces
-        ports = list(set([port for port in ports if port != ''])) # Remove all empty and/or duplicate ports
-        return ports
-
-    # Parse docker information from the docker log
-    # - Docker Log == docker ps --no-trunc --format "{{.ID}}~{{.Names}}~{{.Image}}~{{.Ports}}"
-    def parse_docker(self, docker_log):
-        # Find open the docker log and extract its container information
-        if not os.path.exists(docker_log):
-            return []
-        with open(docker_log, 'r') as log:
-            containers = list(log.read().splitlines())
-
-        # Parse containers into the following format: [[container_id-1, container_name-1, image:version-1, ['host-port-1:container:port-1', ...]]]
-        containers = [container.split('~') for container in containers]
-        containers = [container if container[3] != '' else [container[0], container[1], container[2], 'None/tcp'] for container in containers]
-        containers = [[container[0], container[1], container[2], [re.findall("(?<=:).*", port)[0].replace("->",":") if "->" in port else '{0}:{1}'.format(re.findall(".+?(?=\\/)", port)[0], port) 
-                for port in container[3].split(', ', 1)]] for container in containers]
-        containers = [{'id': container[0], 'name': container[1], 'image': container[2], 'ports': container[3]} for container in containers]
-        return containers
-        
+        return list(self.analysis.ports) # References to ports are collected, without duplicates, while analyzing the trace
+
+    # Parse docker information from the environment's docker log
+    def parse_docker(self):
+        return self.environment.docker
+
     # Parse job contrainer
     def parse_job_container(self):
-        command = 'cat /proc/self/cgroup | grep name=systemd'     
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        container_id = re.findall("(?<=15:name=systemd:\\/docker\/).*", result.stdout.strip())
         for container in self.docker:
-            if container['id'] == container_id:
+            if container['id'] == self.environment.container_id:
                 return container
         return {'id': None, 'name': None, 'image': None, 'ports': None}
 
@@ -1,15 +1,34 @@
 from tracing import Tracing
+import profiling
 import ruamel.yaml
 from ruamel.yaml import YAML
 from ruamel.yaml.scalarstring import LiteralScalarString
+import hashlib
+import json
+import re
 import textwrap
 
+# Scripts that change the state of the shell (e.g. its directory or variables), which every shard of a job has to run
+SETUP_PATTERN = re.compile('^(?:$|#|(?:cd|export|source|\\.|set|unset|alias|shopt|umask|ulimit|pushd|popd|declare|readonly)(?:\\s|$)|[A-Za-z_]\\w*=)')
+
+# Maximum number of combinations that GitHub accepts in a job's matrix
+MAX_MATRIX_COMBINATIONS = 256
+
 # Class that builds .yaml files for CI/CD environments
 class YamlCI:
-    def __init__(self, tracings: list[Tracing], name='Workflow'):
+    def __init__(self, tracings: list[Tracing], name='Workflow', shards=1, dependency_cache=False, setup_job=False, merge='none'):
         self.yaml = {'name': name, 'on': 'push', 'jobs': {}}
+        self.shards = shards # Maximum number of parallel jobs that the scripts of a target are split across
+        self.dependency_cache = dependency_cache # Whether the pip cache and virtualenv are restored with actions/cache
+        self.setup_job = setup_job # Whether virtualenvs are built once by setup jobs and shared with the jobs that need them
+        self.setup_jobs = {} # Dependencies of each setup job, mapped to its id
+        self.job_shards = {} # Jobs that run scripts, mapped to their shard of the target's scripts
         for tracing in tracings:
-            self.construct(tracing, tracing.target)
+            with profiling.phase('yamlci.construct', tracing.target):
+                self.construct(tracing, tracing.target)
+        if merge != 'none':
+            with profiling.phase('yamlci.merge'):
+                self.merge_jobs(merge)
 
     # Specify the virtual machine that will be used to run the application
     def add_runner(self, job_id: str, runner: str):
@@ -26,25 +45,76 @@ class YamlCI:
         job = self.yaml['jobs'][job_id]
         job.update({'container': {'image': image, 'ports': ports}})
 
-    # Add job steps to an existing job
-    def add_step(self, job_id: str, name: str, run: list[str], has_py: bool = False, has_req_log: bool = False, requirements: dict[str, str] = []):
+    # Add job steps to an existing job (with its dependencies installed, or shared by a setup job)
+    def add_step(self, job_id: str, name: str, run: list[str], has_py: bool = False, has_req_log: bool = False, requirements: dict[str, str] = [], setup_job_id: str = None):
         job = self.yaml['jobs'][job_id]
         if 'steps' not in job:
             job.update({'steps': [{'uses': 'actions/checkout@v4'}]})
 
-        dependency_run = []
-        if has_py:
-            job['steps'].append({'uses': 'actions/setup-python@v5', 'with': {'python-version': '${{ matrix.python-version }}', 'cache': 'pip'}})
-            dependency_run.append('python -m pip install --upgrade pip wheel setuptools')
-            if has_req_log:
-                dependency_run.append(f'pip install -r requirements.txt')
-            if len(requirements) > 0:
-                requirements_str = ' '.join([f'{module}=={version}' for module, version in requirements.items()])
-                dependency_run.append(f'pip install -I {requirements_str}')
-        if len(dependency_run) > 0:
-            job['steps'].append({'name': 'Install Python Dependencies', 'run': self.get_multiline_str(dependency_run)})
+        if has_py and setup_job_id is not None:
+            self.add_shared_dependencies(job_id, setup_job_id)
+        elif has_py:
+            self.add_dependencies(job_id, has_req_log, requirements, venv=self.dependency_cache)
+            if self.dependency_cache:
+                self.add_venv_activation(job_id)
         job['steps'].append({'name': name, 'run': self.get_multiline_str(run)})
 
+    # Add steps that install python dependencies (into a virtualenv, restored with actions/cache if dependencies are cached)
+    def add_dependencies(self, job_id: str, has_req_log: bool = False, requirements: dict[str, str] = [], venv: bool = False):
+        job = self.yaml['jobs'][job_id]
+        dependency_run = ['python -m pip install --upgrade pip wheel setuptools']
+        if has_req_log:
+            dependency_run.append(f'pip install -r requirements.txt')
+        if len(requirements) > 0:
+            requirements_str = ' '.join([f'{module}=={version}' for module, version in requirements.items()])
+            dependency_run.append(f'pip install -I {requirements_str}')
+        if not self.dependency_cache:
+            job['steps'].append({'uses': 'actions/setup-python@v5', 'with': {'python-version': '${{ matrix.python-version }}', 'cache': 'pip'}})
+        else:
+            job['steps'].append({'uses': 'actions/setup-python@v5', 'with': {'python-version': '${{ matrix.python-version }}'}})
+            key_prefix = '${{ runner.os }}-python-${{ matrix.python-version }}-'
+            key = key_prefix + ("${{ hashFiles('requirements.txt') }}-" if has_req_log else '') + self.get_requirements_hash(requirements)
+            job['steps'].append({'name': 'Cache Python Dependencies', 'id': 'dependency-cache', 'uses': 'actions/cache@v4',
+                                 'with': {'path': self.get_multiline_str(['~/.cache/pip', '.venv']), 'key': key, 'restore-keys': key_prefix}})
+        if venv:
+            dependency_run = ['python -m venv .venv', 'source .venv/bin/activate'] + dependency_run
+        install = {'name': 'Install Python Dependencies', 'run': self.get_multiline_str(dependency_run)}
+        if self.dependency_cache:
+            install.update({'if': "steps.dependency-cache.outputs.cache-hit != 'true'"}) # Partially restored caches are still updated
+        job['steps'].append(install)
+
+    # Add steps that retrieve the virtualenv built by a setup job
+    def add_shared_dependencies(self, job_id: str, setup_job_id: str):
+        job = self.yaml['jobs'][job_id]
+        job['steps'].append({'uses': 'actions/setup-python@v5', 'with': {'python-version': '${{ matrix.python-version }}'}}) # The virtualenv links to this interpreter
+        job['steps'].append({'uses': 'actions/download-artifact@v4', 'with': {'name': self.get_venv_artifact(setup_job_id)}})
+        job['steps'].append({'name': 'Extract Python Dependencies', 'run': self.get_multiline_str(['tar -xf venv.tar', 'rm venv.tar'])})
+        self.add_venv_activation(job_id)
+
+    # Add a step that activates the virtualenv for the remaining steps of a job
+    def add_venv_activation(self, job_id: str):
+        job = self.yaml['jobs'][job_id]
+        job['steps'].append({'name': 'Activate Python Dependencies', 'run': self.get_multiline_str(['echo "VIRTUAL_ENV=$PWD/.venv" >> "$GITHUB_ENV"', 'echo "$PWD/.venv/bin" >> "$GITHUB_PATH"'])})
+
+    # Add a setup job that builds a virtualenv once and uploads it for the jobs that need it (reusing setup jobs with the same dependencies)
+    def add_setup_job(self, tracing: Tracing, has_req_log: bool = False):
+        dependencies = (tuple(tracing.versions), tracing.job_container['image'], has_req_log, self.get_requirements_hash(tracing.requirements))
+        if dependencies in self.setup_jobs:
+            return self.setup_jobs[dependencies]
+        setup_job_id = 'setup' if len(self.setup_jobs) == 0 else f'setup-{len(self.setup_jobs) + 1}'
+        self.setup_jobs.update({dependencies: setup_job_id})
+        self.yaml['jobs'].update({setup_job_id: {}})
+        self.add_runner(setup_job_id, 'ubuntu-latest')
+        self.add_matrix(setup_job_id, {'python-version': tracing.versions})
+        if tracing.job_container['image'] is not None:
+            self.add_container(setup_job_id, tracing.job_container['image'], tracing.job_container['ports'])
+        self.yaml['jobs'][setup_job_id].update({'steps': [{'uses': 'actions/checkout@v4'}]})
+        self.add_dependencies(setup_job_id, has_req_log, tracing.requirements, venv=True)
+        steps = self.yaml['jobs'][setup_job_id]['steps']
+        steps.append({'name': 'Archive Python Dependencies', 'run': self.get_multiline_str(['tar -cf venv.tar .venv'])}) # Archived to keep symlinks and permissions
+        steps.append({'uses': 'actions/upload-artifact@v4', 'with': {'name': self.get_venv_artifact(setup_job_id), 'path': 'venv.tar', 'retention-days': 1}})
+        return setup_job_id
+
     # Specify a service container that an existing job should be able to use
     def add_service(self, job_id: str, name: str, image: str, ports: list[str]):
         job = self.yaml['jobs'][job_id]
@@ -55,30 +125,108 @@ class YamlCI:
         else:
             job['services'][name]['ports'].extend(ports)
     
+    # Split scripts across at most the given number of shards, balanced by how long each script ran (or by count if untimed)
+    # - Scripts are assigned longest first to the shard with the least total time, and keep their order within shards
+    # - Scripts that set up the shell are run by every shard
+    def shard_scripts(self, scripts: list[str], timings: list[float] = None, shards: int = 1):
+        timings = timings if timings is not None and len(timings) == len(scripts) else [1.0] * len(scripts)
+        setup = set(i for i, script in enumerate(scripts) if SETUP_PATTERN.match(script))
+        work = [i for i in range(len(scripts)) if i not in setup]
+        shards = max(1, min(shards, len(work)))
+        assigned = [[] for _ in range(shards)]
+        totals = [0.0] * shards
+        for i in sorted(work, key=lambda i: -timings[i]):
+            shard = totals.index(min(totals))
+            assigned[shard].append(i)
+            totals[shard] += timings[i]
+        return [[scripts[i] for i in sorted(setup.union(indices))] for indices in assigned]
+
+    # Merge jobs that only differ in the scripts they run (i.e. that have the same runner, matrix, container, services and steps)
+    # - matrix: a single job with a matrix over the targets, whose scripts are included in the matrix (split into several jobs beyond the matrix limit)
+    # - steps: a single job that runs the scripts of each target in consecutive steps (shards are only merged with the same shard of other targets)
+    def merge_jobs(self, mode: str = 'matrix'):
+        groups = {}
+        script_steps = {}
+        for job_id, job in self.yaml['jobs'].items():
+            steps = [step for step in job.get('steps', []) if step.get('name') == 'Execute Test Scripts']
+            if len(steps) != 1: # e.g. setup jobs
+                groups.update({('job', job_id): [job_id]})
+                continue
+            script_steps.update({job_id: steps[0]})
+            environment = {key: value if key != 'steps' else [step for step in value if step is not steps[0]] for key, value in job.items()}
+            signature = json.dumps(environment, sort_keys=True)
+            if mode == 'steps':
+                signature = f'{self.job_shards.get(job_id, 0)}:{signature}'
+            groups.setdefault(('signature', signature), []).append(job_id)
+
+        jobs = {}
+        for group in groups.values():
+            chunk_size = len(group)
+            if mode == 'matrix': # Each target multiplies the combinations of the job's existing matrix
+                combinations = 1
+                for values in self.yaml['jobs'][group[0]].get('strategy', {}).get('matrix', {}).values():
+                    combinations *= len(values)
+                chunk_size = max(1, MAX_MATRIX_COMBINATIONS // combinations)
+            for chunk in range(0, len(group), chunk_size):
+                self.merge_group(jobs, group[chunk:chunk + chunk_size], script_steps, mode)
+        self.yaml['jobs'] = jobs
+
+    # Merge a group of jobs with the same signature into its first job
+    def merge_group(self, jobs: dict, job_ids: list[str], script_steps: dict, mode: str):
+        job = self.yaml['jobs'][job_ids[0]]
+        jobs.update({job_ids[0]: job})
+        if len(job_ids) == 1:
+            return
+        scripts = {job_id: script_steps[job_id]['run'] for job_id in job_ids}
+        index = job['steps'].index(script_steps[job_ids[0]])
+        if mode == 'matrix':
+            matrix = dict(job.get('strategy', {}).get('matrix', {}))
+            matrix.update({'target': job_ids, 'include': [{'target': job_id, 'script': script} for job_id, script in scripts.items()]})
+            job.update({'strategy': {'matrix': matrix, 'fail-fast': False}}) # Targets were independent jobs, so one failing does not cancel the others
+            job['steps'][index] = {'name': 'Execute Test Scripts', 'run': '${{ matrix.script }}'}
+        else:
+            job['steps'][index:index + 1] = [{'name': f'Execute Test Scripts ({job_id})', 'run': script} for job_id, script in scripts.items()]
+
     # Contrust the yaml file using trace information
     def construct(self, tracing: Tracing, job_id='job'):
+        # Rewrite the ids of service containers to their names, which service containers are reachable by, in a single pass over each script
+        names = {container['id']: container['name'] for container in tracing.service_containers if container['id']}
+        if len(names) != 0:
+            pattern = re.compile('|'.join(re.escape(container_id) for container_id in sorted(names, key=len, reverse=True)))
+            tracing.scripts = [pattern.sub(lambda match: names[match.group(0)], script) for script in tracing.scripts]
+        sharded_scripts = self.shard_scripts(tracing.scripts, tracing.timings, self.shards) if self.shards > 1 else [tracing.scripts]
+        setup_job_id = None
+        if self.setup_job and len(tracing.versions) != 0 and len(tracing.scripts) != 0:
+            setup_job_id = self.add_setup_job(tracing, tracing.requirements_log is not None)
+        if len(sharded_scripts) == 1:
+            self.construct_job(tracing, job_id, sharded_scripts[0], setup_job_id)
+            self.job_shards.update({job_id: 0})
+            return
+        for i, scripts in enumerate(sharded_scripts):
+            self.construct_job(tracing, f'{job_id}-{i + 1}', scripts, setup_job_id)
+            self.job_shards.update({f'{job_id}-{i + 1}': i})
+
+    # Contrust a job, which runs the given scripts, using trace information
+    def construct_job(self, tracing: Tracing, job_id: str, scripts: list[str], setup_job_id: str = None):
         if job_id not in self.yaml['jobs']:
             self.yaml['jobs'].update({job_id: {}})
         self.add_runner(job_id, 'ubuntu-latest')
+        if setup_job_id is not None:
+            self.yaml['jobs'][job_id].update({'needs': setup_job_id})
         if len(tracing.versions) != 0:
             self.add_matrix(job_id, {'python-version': tracing.versions})
         if tracing.job_container['image'] is not None:
             self.add_container(job_id, tracing.job_container['image'], tracing.job_container['ports'])
-        if len(tracing.scripts) != 0:
+        if len(scripts) != 0:
             has_py = len(tracing.versions) != 0
             has_req_log = tracing.requirements_log is not None
-            for i in range(len(tracing.scripts)):
-                for container in tracing.service_containers:
-                    if container['id'] in tracing.scripts[i]:
-                        tracing.scripts[i] = tracing.scripts[i].replace(container['id'], container['name'])
-                        break
-            self.add_step(job_id, 'Execute Test Scripts', tracing.scripts, has_py, has_req_log, tracing.requirements)
+            self.add_step(job_id, 'Execute Test Scripts', scripts, has_py, has_req_log, tracing.requirements, setup_job_id)
         for container in tracing.service_containers:
             self.add_service(job_id, container['name'], container['image'], container['ports'])
 
     # Dump the yaml file, as it has been built, to a file
     def dump(self, path: str):
-        with open(path, 'w') as file:
+        with profiling.phase('yamlci.dump'), open(path, 'w') as file:
             ruamel.yaml.representer.RoundTripRepresenter.ignore_aliases = lambda x, y: True
             yaml = YAML()
             yaml.indent(sequence=4, offset=2)
@@ -88,6 +236,15 @@ class YamlCI:
             yaml.ignore_aliases = lambda *args : True
             yaml.dump(data=self.yaml, stream=file)
     
+    # Retrieve a short hash of pinned requirements (e.g. for cache keys)
+    def get_requirements_hash(self, requirements: dict[str, str]):
+        pins = '\n'.join(sorted(f'{module}=={version}' for module, version in dict(requirements).items()))
+        return hashlib.sha256(pins.encode()).hexdigest()[:16]
+
+    # Retrieve the name of the artifact that a setup job uploads its virtualenv as (one per python version)
+    def get_venv_artifact(self, setup_job_id: str):
+        return f'{setup_job_id}-venv-${{{{ matrix.python-version }}}}'
+
     # Retrieve multiline string that will be rendered properly
     def get_multiline_str(self, strs: list[str]):
         newline_strs = '\n'.join(strs) + '\n'